@@ -0,0 +1,185 @@
+"""
+Loaders for the datasets bundled in data/.  The source files are parsed into typed arrays
+the first time they are loaded, and cached as .npy files next to the source, so that later
+loads are fast, memory-mapped reads (the cache is re-built when the source is newer).
+
+    motion_data.pkl                 motion capture scenes, see load_motion_data / load_motion_events
+    zachs2006_data021011.dat        human event boundaries (Zacks et al., 2006), see load_zacks2006
+    zachs_2006_young_*.csv          young subjects' boundary frequency, see load_zacks2006_young
+
+"""
+import os
+import pickle
+import numpy as np
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+# lengths (in seconds) of the movies of Zacks et al. (2006)
+ZACKS2006_MOVIES = dict(
+    A=185,  # saxophone
+    B=336,  # making a bed
+    C=255,  # doing dishes
+)
+
+
+def _source(filename, data_path):
+    if data_path is None:
+        data_path = DATA_PATH
+    return os.path.join(data_path, filename)
+
+
+def _load_cached(source, names, parse):
+    """
+    Returns the arrays parsed from source, cached as <source>.<name>.npy.  Cached arrays are
+    read-only memory-maps
+
+    :param source: path of the source file
+    :param names: names of the arrays returned by parse
+    :param parse: function(source) returning a tuple of arrays
+    """
+    cache = [source + '.' + name + '.npy' for name in names]
+    if all(os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source) for path in cache):
+        return tuple(np.load(path, mmap_mode='r') for path in cache)
+
+    arrays = parse(source)
+    try:
+        for path, array in zip(cache, arrays):
+            np.save(path, array)
+    except OSError:
+        # read-only data directory, parse the source every time
+        pass
+    return arrays
+
+
+class _Stub(object):
+    # placeholder for the pandas objects in a pickled DataFrame, which only keeps their state
+    def __init__(self, *args):
+        self.args = args
+
+    def __setstate__(self, state):
+        self.state = state
+
+
+def _new_stub(*args):
+    return _Stub(*args)
+
+
+class _DataFrameUnpickler(pickle.Unpickler):
+    # reads a pickled pandas DataFrame without pandas, only numpy objects are reconstructed
+    def find_class(self, module, name):
+        if module.split('.')[0] == 'pandas':
+            return _new_stub if name.startswith('_new_') else _Stub
+        if module == 'numpy.core.multiarray' and name == '_reconstruct':
+            return np.ndarray.__reduce__(np.zeros(0))[0]
+        if module == 'numpy' and name in ('ndarray', 'dtype'):
+            return getattr(np, name)
+        if module in ('__builtin__', 'builtins') and name == 'slice':
+            return slice
+        raise pickle.UnpicklingError('unexpected object in the data file: {}.{}'.format(module, name))
+
+
+def _parse_dataframe_pickle(source):
+    """
+    Parses a pickled pandas DataFrame (BlockManager format) into a dictionary of columns
+    """
+    with open(source, 'rb') as f:
+        df = _DataFrameUnpickler(f, encoding='latin1').load()
+    block_manager = df.state['_data'].state
+    managers = [s for s in block_manager if isinstance(s, dict)][0]
+    manager = list(managers.values())[0]
+
+    columns = manager['axes'][0].args[1]['data']
+    n_rows = len(manager['axes'][1].args[1]['data'])
+    values = np.zeros((len(columns), n_rows))
+    for block in manager['blocks']:
+        values[block['mgr_locs']] = block['values']
+    return {column: values[ii] for ii, column in enumerate(columns)}
+
+
+def _parse_motion_data(source):
+    columns = _parse_dataframe_pickle(source)
+    event_numbers = columns.pop('EventNumber').astype(np.int64)
+    x = np.stack(list(columns.values()), axis=1)
+    return x, event_numbers
+
+
+def load_motion_data(data_path=None):
+    """
+    Motion capture data (data/motion_data.pkl)
+
+    :param data_path: directory of the data files (default: the bundled data/)
+    :return: x, n x 54 array of scenes, ready for SEM.run
+             event_numbers, n-length array of the event each scene belongs to
+    """
+    return _load_cached(_source('motion_data.pkl', data_path), ('x', 'event_numbers'), _parse_motion_data)
+
+
+def load_motion_events(data_path=None):
+    """
+    Motion capture data (data/motion_data.pkl), split into events
+
+    :param data_path: directory of the data files (default: the bundled data/)
+    :return: list of n_scenes x 54 arrays, one per event, ready for SEM.run_w_boundaries
+    """
+    x, event_numbers = load_motion_data(data_path)
+    boundaries = np.nonzero(np.diff(event_numbers))[0] + 1
+    return np.split(np.asarray(x), boundaries, axis=0)
+
+
+def _parse_zacks2006(source):
+    raw = np.loadtxt(source, delimiter='\t', skiprows=1, dtype=str)
+    data = np.zeros(raw.shape[0], dtype=[('subject', 'U8'), ('condition', 'U8'), ('movie', 'U1'), ('ms', np.int64)])
+    data['subject'], data['condition'], data['movie'] = raw[:, 0], raw[:, 1], raw[:, 2]
+    data['ms'] = raw[:, 3].astype(np.int64)
+    return data,
+
+
+def load_zacks2006(data_path=None):
+    """
+    Human event boundaries of Zacks et al. (2006) (data/zachs2006_data021011.dat)
+
+    :param data_path: directory of the data files (default: the bundled data/)
+    :return: structured array with a record per boundary and the fields subject, condition
+             ('warned' or 'unwarned'), movie ('A', 'B' or 'C', see ZACKS2006_MOVIES) and ms,
+             the time of the boundary in milliseconds
+    """
+    return _load_cached(_source('zachs2006_data021011.dat', data_path), ('data',), _parse_zacks2006)[0]
+
+
+def zacks2006_boundary_frequency(movie, bin_size=1.0, data_path=None):
+    """
+    Binned frequency of the human event boundaries of a movie, collapsed over all of the
+    subjects and conditions, for comparison to the boundaries of SEM
+
+    :param movie: 'A', 'B' or 'C' (see ZACKS2006_MOVIES)
+    :param bin_size: size of the bins in seconds
+    :param data_path: directory of the data files (default: the bundled data/)
+    :return: array with the number of boundaries per bin, divided by the number of subjects
+    """
+    data = load_zacks2006(data_path)
+    n_subjs = len(np.unique(data['subject']))
+    times = np.unique(data['ms'][data['movie'] == movie]).astype(np.float32)
+
+    edges = np.arange(bin_size, ZACKS2006_MOVIES[movie] + bin_size, bin_size) * 1000
+    cumulative = np.searchsorted(times, edges, side='right')
+    return np.diff(np.concatenate([[0], cumulative])) / float(n_subjs)
+
+
+def _parse_zacks2006_young(source):
+    raw = np.loadtxt(source, delimiter=',', ndmin=2)
+    return raw[:, 0], raw[:, 1]
+
+
+def load_zacks2006_young(condition='warned', data_path=None):
+    """
+    Boundary frequency of the young subjects of Zacks et al. (2006) (data/zachs_2006_young_*.csv)
+
+    :param condition: 'warned' or 'unwarned'
+    :param data_path: directory of the data files (default: the bundled data/)
+    :return: times, array of times (in seconds)
+             frequency, array of the boundary frequency at each time
+    """
+    if condition not in ('warned', 'unwarned'):
+        raise ValueError("condition must be 'warned' or 'unwarned'")
+    source = _source('zachs_2006_young_{}.csv'.format(condition), data_path)
+    return _load_cached(source, ('times', 'frequency'), _parse_zacks2006_young)
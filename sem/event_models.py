@@ -1,3 +1,4 @@
+import threading
 import tensorflow as tf
 import numpy as np
 from tensorflow.keras.models import Sequential
@@ -5,8 +6,8 @@ from tensorflow.keras.layers import Dense, Activation, SimpleRNN, GRU, Dropout,
 from tensorflow.keras import regularizers
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.backend import l2_normalize
-from .utils import fast_mvnorm_diagonal_logprob, unroll_data, get_prior_scale, delete_object_attributes
-from scipy.stats import norm
+from .utils import diagonal_mvnorm_logprob, unroll_data, unroll_last, get_prior_scale, delete_object_attributes, \
+    log_2pi, ReplayBuffer
 
 print("TensorFlow Version: {}".format(tf.__version__))
 
@@ -15,6 +16,16 @@ import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 
+# a thread can use its own copy of the network for every event model, e.g. to train in the
+# background while the main thread runs inference (the weights are stored per event model)
+_thread_state = threading.local()
+
+
+def set_thread_model(model):
+    """ use model, instead of the network shared by the event models, in the calling thread """
+    _thread_state.model = model
+
+
 def map_variance(samples, nu0, var0):
     """
     This estimator assumes an scaled inverse-chi squared prior over the
@@ -58,10 +69,17 @@ class LinearEvent(object):
     def __init__(self, d, var_df0=None, var_scale0=None, optimizer=None, n_epochs=10, init_model=False,
                  kernel_initializer='glorot_uniform', l2_regularization=0.00, batch_size=32, prior_log_prob=None,
                  reset_weights=False, batch_update=True, optimizer_kwargs=None, variance_prior_mode=None, 
-                 variance_window=None):
+                 variance_window=None, replay_capacity=None, replay_mode='reservoir', update_scheduler=None):
         """
 
         :param d: dimensions of the input space
+        :param replay_capacity: maximum number of training pairs stored for the minibatches (None
+                                stores all of them)
+        :param replay_mode: 'reservoir' (uniform sample of the history) or 'recency' (biased
+                            towards recent pairs), see utils.ReplayBuffer
+        :param update_scheduler: decides which updates train the network, and for how many epochs
+                                 (see training.UpdateScheduler).  None trains on every update for
+                                 n_epochs
         """
         self.d = d
         self.f_is_trained = False
@@ -111,6 +129,11 @@ class LinearEvent(object):
             
         self.prior_probability = prior_log_prob
 
+        # closed form of the fallback log probability of a scene under X ~ N(0, variance_prior_mode * I),
+        # used when there is no prior_log_prob and the model is untrained
+        self._prior_log_norm = -0.5 * d * (log_2pi + np.log(variance_prior_mode))
+        self._prior_inv_var = 1. / variance_prior_mode
+
         # how many observations do we consider in calculating the variance?
         if variance_window is None:
             variance_window = int(1e6) # this is plausiblely large...
@@ -136,7 +159,8 @@ class LinearEvent(object):
         self.d = d
         self.reset_weights = reset_weights
         self.batch_update = batch_update
-        self.training_pairs = []
+        self.training_pairs = ReplayBuffer(replay_capacity, replay_mode)
+        self.update_scheduler = update_scheduler
         self.prediction_errors = np.zeros((0, self.d), dtype=np.float)
         self.model_weights = None
 
@@ -152,6 +176,17 @@ class LinearEvent(object):
     def clear(self):
         delete_object_attributes(self)
 
+    @property
+    def model(self):
+        thread_model = getattr(_thread_state, 'model', None)
+        if thread_model is not None:
+            return thread_model
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+
     def init_model(self):
         self._compile_model()
         self.model_weights = self.model.get_weights()
@@ -193,6 +228,15 @@ class LinearEvent(object):
         -------
         None
 
+        """
+        self.fit_pair(*self.add_to_history(X, Xp), update_estimate=update_estimate)
+
+    def add_to_history(self, X, Xp):
+        """
+        First half of update: adds X to the history of the active event token (which the
+        predictions condition on) and returns the training pair (x, xp) of the update.  See
+        fit_pair for the second half, which can run on another thread (training.AsyncTrainer)
+
         """
         if X.ndim > 1:
             X = X[-1, :]  # only consider last example
@@ -202,30 +246,88 @@ class LinearEvent(object):
         assert Xp.shape[0] == self.d
 
         x_example = X.reshape((1, self.d))
-        xp_example = Xp.reshape((1, self.d))
 
         # concatenate the training example to the active event token
         self.x_history[-1] = np.concatenate([self.x_history[-1], x_example], axis=0)
+        return X, Xp
 
-        # also, create a list of training pairs (x, y) for efficient sampling
+    def fit_pair(self, x_train, xp_train, update_estimate=True):
+        """ second half of update: stores the training pair and trains on it """
+        # store the training pair (x, y) for efficient sampling
         #  picks  random time-point in the history
-        self.training_pairs.append(tuple([x_example, xp_example]))
+        self.training_pairs.append(x_train, xp_train)
 
         if update_estimate:
             self.estimate()
             self.f_is_trained = True
 
     def update_f0(self, Xp, update_estimate=True):
-        self.update(np.zeros(self.d), Xp, update_estimate=update_estimate)
-        self.f0_is_trained = True
+        self.fit_f0(*self.add_to_history(np.zeros(self.d), Xp), update_estimate=update_estimate)
 
-        # precompute f0 for speed
+    def fit_f0(self, x_train, xp_train, update_estimate=True):
+        """ second half of update_f0, see add_to_history """
+        self.fit_pair(x_train, xp_train, update_estimate=update_estimate)
+
+        # precompute f0 for speed.  f0 is set before the flag, as the inference thread can read
+        # both while a training thread runs fit_f0
         self.f0 = self._predict_f0()
+        self.f0_is_trained = True
+
+    @property
+    def Sigma(self):
+        return self._Sigma
+
+    @Sigma.setter
+    def Sigma(self, Sigma):
+        # cache the inverse and the log-determinant for the likelihood, whenever Sigma changes.
+        # (all three are set in a single update, as Sigma can be updated by a training thread)
+        Sigma = np.asarray(Sigma)
+        self.__dict__.update(_Sigma=Sigma, Sigma_inv=1. / Sigma, Sigma_log_det=np.sum(np.log(Sigma)))
 
     def get_variance(self):
         # Sigma is stored as a vector corresponding to the entries of the diagonal covariance matrix
         return self.Sigma
 
+    def get_state(self):
+        """
+        Returns the learned state of the event model (weights, variance, training data and
+        histories) as a flat dictionary of arrays, e.g. for np.savez_compressed.  The
+        hyperparameters are not included; they are set in __init__
+
+        """
+        state = dict(
+            f0=np.asarray(self.f0),
+            Sigma=self.Sigma,
+            prediction_errors=self.prediction_errors,
+            is_trained=np.array([self.f_is_trained, self.f0_is_trained, self.is_visited]),
+            x_history=np.concatenate(self.x_history, axis=0),
+            x_history_lengths=np.array([np.shape(x)[0] for x in self.x_history], dtype=int),
+        )
+        for key, value in self.training_pairs.get_state().items():
+            state['training_' + key] = value
+        if self.model_weights is not None:
+            for ii, w in enumerate(self.model_weights):
+                state['model_weights_{}'.format(ii)] = w
+        return state
+
+    def set_state(self, state):
+        """
+        Restores the learned state returned by get_state.  The model (and its weights) are
+        shared across event models, so set_model should be called first
+
+        """
+        self.f0 = state['f0']
+        self.Sigma = state['Sigma']
+        self.prediction_errors = state['prediction_errors']
+        self.f_is_trained, self.f0_is_trained, self.is_visited = [bool(b) for b in state['is_trained']]
+        self.x_history = np.split(state['x_history'], np.cumsum(state['x_history_lengths'])[:-1], axis=0)
+        self.training_pairs.set_state(
+            {key[len('training_'):]: value for key, value in state.items() if key.startswith('training_')}
+        )
+        n_weights = len([key for key in state.keys() if key.startswith('model_weights_')])
+        if n_weights > 0:
+            self.model_weights = [state['model_weights_{}'.format(ii)] for ii in range(n_weights)]
+
     def predict_next(self, X):
         """
         wrapper for the prediction function that changes the prediction to the identity function
@@ -271,39 +373,43 @@ class LinearEvent(object):
     def _predict_f0(self):
         return self._predict_next(np.zeros(self.d))
 
+    def prior_log_likelihood(self, Xp):
+        # log probability of Xp under the variance prior, X ~ N(0, variance_prior_mode * I)
+        return self._prior_log_norm - 0.5 * np.sum(np.square(Xp)) * self._prior_inv_var
+
     def log_likelihood_f0(self, Xp):
 
         if not self.f0_is_trained:
             if self.prior_probability:
                 return self.prior_probability
             else: 
-                return norm(0, self.variance_prior_mode ** 0.5).logpdf(Xp).sum()
+                return self.prior_log_likelihood(Xp)
 
         # predict the initial point
         Xp_hat = self.predict_f0()
 
         # return the probability
-        return fast_mvnorm_diagonal_logprob(Xp.reshape(-1) - Xp_hat.reshape(-1), self.Sigma)
+        return diagonal_mvnorm_logprob(Xp.reshape(-1) - Xp_hat.reshape(-1), self.Sigma_inv, self.Sigma_log_det)
 
     def log_likelihood_next(self, X, Xp):
         if not self.f_is_trained:
             if self.prior_probability:
                 return self.prior_probability
             else: 
-                return norm(0, self.variance_prior_mode ** 0.5).logpdf(Xp).sum()
+                return self.prior_log_likelihood(Xp)
 
         Xp_hat = self.predict_next(X)
-        return fast_mvnorm_diagonal_logprob(Xp.reshape(-1) - Xp_hat.reshape(-1), self.Sigma)
+        return diagonal_mvnorm_logprob(Xp.reshape(-1) - Xp_hat.reshape(-1), self.Sigma_inv, self.Sigma_log_det)
 
     def log_likelihood_sequence(self, X, Xp):
         if not self.f_is_trained:
             if self.prior_probability:
                 return self.prior_probability
             else: 
-                return norm(0, self.variance_prior_mode ** 0.5).logpdf(Xp).sum()
+                return self.prior_log_likelihood(Xp)
 
         Xp_hat = self.predict_next_generative(X)
-        return fast_mvnorm_diagonal_logprob(Xp.reshape(-1) - Xp_hat.reshape(-1), self.Sigma)
+        return diagonal_mvnorm_logprob(Xp.reshape(-1) - Xp_hat.reshape(-1), self.Sigma_inv, self.Sigma_log_det)
 
     # create a new cluster of scenes
     def new_token(self):
@@ -317,6 +423,33 @@ class LinearEvent(object):
         # the LDS is a markov model, so these functions are the same
         return self.predict_next(X)
 
+    def predict_next_generative_batch(self, X):
+        """
+        batched version of predict_next_generative
+
+        Parameters
+        ----------
+        X: NxD array-like sequence of inputs
+
+        Returns
+        -------
+        y: NxD array, row ii is the prediction conditioned on X[:ii + 1, :]
+
+        """
+        if not self.f_is_trained:
+            return np.copy(X)
+        self.model.set_weights(self.model_weights)
+        # the LDS is a markov model, so each prediction only depends on the preceding scene
+        return self.model.predict(X)
+
+    def _draw_batch(self):
+        if self.batch_update:
+            # draw a random set of pairs from the history
+            return self.training_pairs.sample(self.batch_size)
+        # for online sampling, just use the last training sample
+        x_sample, xp_sample = self.training_pairs.last()
+        return np.repeat(x_sample, self.batch_size, axis=0), np.repeat(xp_sample, self.batch_size, axis=0)
+
     def run_generative(self, n_steps, initial_point=None):
         self.model.set_weights(self.model_weights)
         if initial_point is None:
@@ -327,69 +460,108 @@ class LinearEvent(object):
             x_gen = np.concatenate([x_gen, self.predict_next_generative(x_gen[:ii, :])])
         return x_gen
 
-    def estimate(self):
+    def estimate_all(self, n_passes=1):
+        """
+        Trains the network on all of the stored training pairs at once (e.g. for pretraining
+        with known event types), instead of a set of minibatches per update, then estimates the
+        variance from the prediction errors on all of the pairs
+
+        :param n_passes: number of full passes (epochs of model.fit) over all of the training
+                         pairs.  Unlike self.n_epochs, the number of minibatches per update,
+                         each pass trains on every pair
+        """
         if self.reset_weights:
             self.do_reset_weights()
         else:
             self.model.set_weights(self.model_weights)
 
-        n_pairs = len(self.training_pairs)
+        x_train, xp_train = self.training_pairs.all()
+        self.model.fit(x_train, xp_train, epochs=n_passes, batch_size=self.batch_size, shuffle=True, verbose=0)
+        self.model_weights = self.model.get_weights()
 
-        if self.batch_update:
-            def draw_sample_pair():
-                # draw a random cluster for the history
-                idx = np.random.randint(n_pairs)
-                return self.training_pairs[idx]
-        else:
-            # for online sampling, just use the last training sample
-            def draw_sample_pair():
-                return self.training_pairs[-1]
+        # Update Sigma
+        self.prediction_errors = (xp_train - self.model.predict(x_train))[-self.variance_window:, :]
+        self._update_variance()
+
+        self.f_is_trained = True
+        if self.f0_is_trained:
+            self.f0 = self._predict_f0()
 
+    def _should_train(self):
+        # an untrained model always trains
+        if self.update_scheduler is None or not self.f_is_trained:
+            return True
+        return self.update_scheduler.should_train(self)
+
+    def _train(self):
         # run batch gradient descent on all of the past events!
+        losses = []
         for _ in range(self.n_epochs):
 
             # draw a set of training examples from the history
-            x_batch = []
-            xp_batch = []
-            for _ in range(self.batch_size):
-
-                x_sample, xp_sample = draw_sample_pair()
+            x_batch, xp_batch = self._draw_batch()
+            losses.append(self.model.train_on_batch(x_batch, xp_batch))
 
-                # these data aren't
-                x_batch.append(x_sample)
-                xp_batch.append(xp_sample)
+            if self.update_scheduler is not None and not self.update_scheduler.keep_training(losses):
+                break
 
-            x_batch = np.reshape(x_batch, (self.batch_size, self.d))
-            xp_batch = np.reshape(xp_batch, (self.batch_size, self.d))
-            self.model.train_on_batch(x_batch, xp_batch)
-
-        # cache the model weights
-        self.model_weights = self.model.get_weights()
+    def last_prediction_error(self):
+        """ prediction error of the current weights on the most recent training pair """
+        x_train_0, xp_train_0 = self.training_pairs.last()
+        self.model.set_weights(self.model_weights)
+        return xp_train_0 - self.model.predict(x_train_0)
 
-        # Update Sigma
-        x_train_0, xp_train_0 = self.training_pairs[-1]
+    def _update_prediction_errors(self):
+        x_train_0, xp_train_0 = self.training_pairs.last()
         xp_hat = self.model.predict(x_train_0)
         self.prediction_errors = np.concatenate([self.prediction_errors, xp_train_0 - xp_hat], axis=0)
         # remove old observations from consideration of the variance
         t = np.max([0, np.shape(self.prediction_errors)[0] - self.variance_window])
         self.prediction_errors = self.prediction_errors[t:, :]
 
+        # update the variance
+        self._update_variance()
+
+    def _update_variance(self):
         if np.shape(self.prediction_errors)[0] > 1:
             self.Sigma = map_variance(self.prediction_errors, self.var_df0, self.var_scale0)
 
+    def estimate(self):
+        if not self._should_train():
+            # skip the gradient steps, the prediction error still counts towards the variance
+            self.model.set_weights(self.model_weights)
+            self._update_prediction_errors()
+            return
+
+        if self.reset_weights:
+            self.do_reset_weights()
+        else:
+            self.model.set_weights(self.model_weights)
+
+        self._train()
+
+        # cache the model weights
+        self.model_weights = self.model.get_weights()
+
+        # Update Sigma
+        self._update_prediction_errors()
+
 
 class NonLinearEvent(LinearEvent):
 
     def __init__(self, d, var_df0=None, var_scale0=None, n_hidden=None, hidden_act='tanh', batch_size=32,
                  optimizer=None, n_epochs=10, init_model=False, kernel_initializer='glorot_uniform',
                  l2_regularization=0.00, dropout=0.50, prior_log_prob=None, reset_weights=False,
-                 batch_update=True, optimizer_kwargs=None, variance_prior_mode=None, variance_window=None):
+                 batch_update=True, optimizer_kwargs=None, variance_prior_mode=None, variance_window=None,
+                 replay_capacity=None, replay_mode='reservoir', update_scheduler=None):
         LinearEvent.__init__(self, d, var_df0=var_df0, var_scale0=var_scale0, optimizer=optimizer, n_epochs=n_epochs,
                              init_model=False, kernel_initializer=kernel_initializer, batch_size=batch_size,
                              l2_regularization=l2_regularization, prior_log_prob=prior_log_prob,
                              reset_weights=reset_weights, batch_update=batch_update,
                              optimizer_kwargs=optimizer_kwargs, variance_prior_mode=variance_prior_mode, 
-                             variance_window=variance_window)
+                             variance_window=variance_window,
+                             replay_capacity=replay_capacity, replay_mode=replay_mode,
+                             update_scheduler=update_scheduler)
 
         if n_hidden is None:
             n_hidden = d
@@ -417,14 +589,17 @@ class NonLinearEvent_normed(NonLinearEvent):
     def __init__(self, d, var_df0=None, var_scale0=None, n_hidden=None, hidden_act='tanh',
                  optimizer=None, n_epochs=10, init_model=False, kernel_initializer='glorot_uniform',
                  l2_regularization=0.00, dropout=0.50, prior_log_prob=None, reset_weights=False, batch_size=32,
-                 batch_update=True, optimizer_kwargs=None, variance_prior_mode=None, variance_window=None):
+                 batch_update=True, optimizer_kwargs=None, variance_prior_mode=None, variance_window=None,
+                 replay_capacity=None, replay_mode='reservoir', update_scheduler=None):
 
         NonLinearEvent.__init__(self, d, var_df0=var_df0, var_scale0=var_scale0,optimizer=optimizer, n_epochs=n_epochs,
                                      l2_regularization=l2_regularization,batch_size=batch_size,
                                      kernel_initializer=kernel_initializer, init_model=False,
                                      prior_log_prob=prior_log_prob, reset_weights=reset_weights,
                                      batch_update=batch_update, optimizer_kwargs=optimizer_kwargs,
-                                     variance_prior_mode=variance_prior_mode, variance_window=variance_window)
+                                     variance_prior_mode=variance_prior_mode, variance_window=variance_window,
+                                     replay_capacity=replay_capacity, replay_mode=replay_mode,
+                                     update_scheduler=update_scheduler)
 
         if n_hidden is None:
             n_hidden = d
@@ -464,6 +639,13 @@ class StationaryEvent(LinearEvent):
 
         return self.model.predict(np.zeros((1, self.d)))
 
+    def predict_next_generative_batch(self, X):
+        if not self.f_is_trained:
+            return np.copy(X)
+        # the prediction does not depend on the inputs
+        self.model.set_weights(self.model_weights)
+        return np.tile(self.model.predict(np.zeros((1, self.d))), (np.shape(X)[0], 1))
+
 
 class RecurrentLinearEvent(LinearEvent):
 
@@ -473,7 +655,8 @@ class RecurrentLinearEvent(LinearEvent):
     def __init__(self, d, var_df0=None, var_scale0=None, t=3,
                  optimizer=None, n_epochs=10, l2_regularization=0.00, batch_size=32,
                  kernel_initializer='glorot_uniform', init_model=False, prior_log_prob=None, reset_weights=False,
-                 batch_update=True, optimizer_kwargs=None,variance_prior_mode=None,variance_window=None):
+                 batch_update=True, optimizer_kwargs=None,variance_prior_mode=None,variance_window=None,
+                 replay_capacity=None, replay_mode='reservoir', update_scheduler=None):
 
         LinearEvent.__init__(self, d, var_df0=var_df0, var_scale0=var_scale0,
                              optimizer=optimizer, n_epochs=n_epochs,
@@ -481,7 +664,9 @@ class RecurrentLinearEvent(LinearEvent):
                              l2_regularization=l2_regularization, prior_log_prob=prior_log_prob,
                              reset_weights=reset_weights, batch_update=batch_update, 
                              optimizer_kwargs=optimizer_kwargs, variance_prior_mode=variance_prior_mode,
-                             variance_window=variance_window)
+                             variance_window=variance_window,
+                             replay_capacity=replay_capacity, replay_mode=replay_mode,
+                             update_scheduler=update_scheduler)
 
         self.t = t
         self.n_epochs = n_epochs
@@ -512,6 +697,19 @@ class RecurrentLinearEvent(LinearEvent):
         else:
             self.model.set_weights(self.init_weights)
 
+    def get_state(self):
+        state = LinearEvent.get_state(self)
+        if self.init_weights is not None:
+            for ii, w in enumerate(self.init_weights):
+                state['init_weights_{}'.format(ii)] = w
+        return state
+
+    def set_state(self, state):
+        LinearEvent.set_state(self, state)
+        n_weights = len([key for key in state.keys() if key.startswith('init_weights_')])
+        if n_weights > 0:
+            self.init_weights = [state['init_weights_{}'.format(ii)] for ii in range(n_weights)]
+
     # initialize model once so we can then update it online
     def _compile_model(self):
         self.model = Sequential()
@@ -524,10 +722,8 @@ class RecurrentLinearEvent(LinearEvent):
     # this is for the recurrent layer
     #
     def _unroll(self, x_example):
-        x_train = np.concatenate([self.x_history[-1][-(self.t - 1):, :], x_example], axis=0)
-        x_train = np.concatenate([np.zeros((self.t - x_train.shape[0], self.d)), x_train], axis=0)
-        x_train = x_train.reshape((1, self.t, self.d))
-        return x_train
+        x_history = self.x_history[-1][max(np.shape(self.x_history[-1])[0] - self.t + 1, 0):, :]
+        return unroll_last(np.concatenate([x_history, x_example], axis=0), self.t)
 
     # predict a single example
     def _predict_next(self, X):
@@ -549,44 +745,40 @@ class RecurrentLinearEvent(LinearEvent):
     def _predict_f0(self):
         return self.predict_next_generative(np.zeros(self.d))
 
-    def _update_variance(self):
-        if np.shape(self.prediction_errors)[0] > 1:
-            self.Sigma = map_variance(self.prediction_errors, self.var_df0, self.var_scale0)
+    def add_to_history(self, X, Xp):
+        LinearEvent.add_to_history(self, X, Xp)
 
-    def update(self, X, Xp, update_estimate=True):
-        if X.ndim > 1:
-            X = X[-1, :]  # only consider last example
-        assert X.ndim == 1
-        assert X.shape[0] == self.d
-        assert Xp.ndim == 1
-        assert Xp.shape[0] == self.d
+        # the input of the training pair is the last t scenes of the active event token
+        x_train_example = unroll_last(self.x_history[-1], self.t)
+        return x_train_example[0], Xp
 
-        x_example = X.reshape((1, self.d))
-        xp_example = Xp.reshape((1, self.d))
+    def predict_next_generative(self, X):
+        self.model.set_weights(self.model_weights)
+        return self.model.predict(unroll_last(X, self.t))
 
-        # concatenate the training example to the active event token
-        self.x_history[-1] = np.concatenate([self.x_history[-1], x_example], axis=0)
+    def predict_next_generative_batch(self, X):
+        """
+        batched version of predict_next_generative
 
-        # also, create a list of training pairs (x, y) for efficient sampling
-        #  picks  random time-point in the history
-        _n = np.shape(self.x_history[-1])[0]
-        x_train_example = np.reshape(
-                    unroll_data(self.x_history[-1][max(_n - self.t, 0):, :], self.t)[-1, :, :], (1, self.t, self.d)
-                )
-        self.training_pairs.append(tuple([x_train_example, xp_example]))
+        Parameters
+        ----------
+        X: NxD array-like sequence of inputs
 
-        if update_estimate:
-            self.estimate()
-            self.f_is_trained = True
+        Returns
+        -------
+        y: NxD array, row ii is the prediction conditioned on X[:ii + 1, :]
 
-    def predict_next_generative(self, X):
+        """
+        if not self.f_is_trained:
+            return np.copy(X)
         self.model.set_weights(self.model_weights)
-        X0 = np.reshape(unroll_data(X, self.t)[-1, :, :], (1, self.t, self.d))
-        return self.model.predict(X0)
+        # every window of the unrolled sequence is predicted in a single call
+        return self.model.predict(unroll_data(X, self.t))
 
     # optional: run batch gradient descent on all past event clusters
     def estimate(self):
-        if self.reset_weights:
+        train = self._should_train()
+        if self.reset_weights and train:
             self.do_reset_weights()
         else:
             self.model.set_weights(self.model_weights)
@@ -596,45 +788,14 @@ class RecurrentLinearEvent(LinearEvent):
         # origin, deterministically
 
         # Update Sigma
-        x_train_0, xp_train_0 = self.training_pairs[-1]
-        xp_hat = self.model.predict(x_train_0)
-        self.prediction_errors = np.concatenate([self.prediction_errors, xp_train_0 - xp_hat], axis=0)
-                
-        # remove old observations from consideration of the variance
-        t = np.max([0, np.shape(self.prediction_errors)[0] - self.variance_window])
-        self.prediction_errors = self.prediction_errors[t:, :]
-
-        # update the variance
-        self._update_variance()
+        self._update_prediction_errors()
 
+        if not train:
+            # skip the gradient steps
+            return
 
         ## then update the NN
-        n_pairs = len(self.training_pairs)
-
-        if self.batch_update:
-            def draw_sample_pair():
-                # draw a random cluster for the history
-                idx = np.random.randint(n_pairs)
-                return self.training_pairs[idx]
-        else:
-            # for online sampling, just use the last training sample
-            def draw_sample_pair():
-                return self.training_pairs[-1]
-
-        # run batch gradient descent on all of the past events!
-        for _ in range(self.n_epochs):
-
-            # draw a set of training examples from the history
-            x_batch = np.zeros((0, self.t, self.d))
-            xp_batch = np.zeros((0, self.d))
-            for _ in range(self.batch_size):
-
-                x_sample, xp_sample = draw_sample_pair()
-
-                x_batch = np.concatenate([x_batch, x_sample], axis=0)
-                xp_batch = np.concatenate([xp_batch, xp_sample], axis=0)
-
-            self.model.train_on_batch(x_batch, xp_batch)
+        self._train()
         self.model_weights = self.model.get_weights()
 
 
@@ -643,7 +804,8 @@ class RecurrentEvent(RecurrentLinearEvent):
     def __init__(self, d, var_df0=None, var_scale0=None, t=3, n_hidden=None, optimizer=None,
                  n_epochs=10, dropout=0.50, l2_regularization=0.00, batch_size=32,
                  kernel_initializer='glorot_uniform', init_model=False, prior_log_prob=None, reset_weights=False, 
-                 batch_update=True, optimizer_kwargs=None, variance_prior_mode=None,variance_window=None):
+                 batch_update=True, optimizer_kwargs=None, variance_prior_mode=None,variance_window=None,
+                 replay_capacity=None, replay_mode='reservoir', update_scheduler=None):
 
         RecurrentLinearEvent.__init__(self, d, var_df0, var_scale0=None, t=t,
                                       optimizer=optimizer, n_epochs=n_epochs,
@@ -651,7 +813,9 @@ class RecurrentEvent(RecurrentLinearEvent):
                                       kernel_initializer=kernel_initializer, init_model=False,
                                       prior_log_prob=prior_log_prob, reset_weights=reset_weights,
                                       batch_update=batch_update, optimizer_kwargs=optimizer_kwargs,
-                                      variance_prior_mode=variance_prior_mode, variance_window=variance_window)
+                                      variance_prior_mode=variance_prior_mode, variance_window=variance_window,
+                                      replay_capacity=replay_capacity, replay_mode=replay_mode,
+                                      update_scheduler=update_scheduler)
 
         if n_hidden is None:
             self.n_hidden = d
@@ -681,7 +845,8 @@ class GRUEvent(RecurrentLinearEvent):
     def __init__(self, d, var_df0=None, var_scale0=None, t=3, n_hidden=None, optimizer=None,
                  n_epochs=10, dropout=0.50, l2_regularization=0.00, batch_size=32,
                  kernel_initializer='glorot_uniform', init_model=False, prior_log_prob=None, reset_weights=False,
-                 batch_update=True, optimizer_kwargs=None,variance_prior_mode=None,variance_window=None):
+                 batch_update=True, optimizer_kwargs=None,variance_prior_mode=None,variance_window=None,
+                 replay_capacity=None, replay_mode='reservoir', update_scheduler=None):
 
         RecurrentLinearEvent.__init__(self, d, var_df0=var_df0, var_scale0=var_scale0, t=t,
                                       optimizer=optimizer, n_epochs=n_epochs,
@@ -689,7 +854,9 @@ class GRUEvent(RecurrentLinearEvent):
                                       kernel_initializer=kernel_initializer, init_model=False,
                                       prior_log_prob=prior_log_prob, reset_weights=reset_weights,
                                       batch_update=batch_update, optimizer_kwargs=optimizer_kwargs,
-                                      variance_prior_mode=variance_prior_mode, variance_window=variance_window)
+                                      variance_prior_mode=variance_prior_mode, variance_window=variance_window,
+                                      replay_capacity=replay_capacity, replay_mode=replay_mode,
+                                      update_scheduler=update_scheduler)
 
         if n_hidden is None:
             self.n_hidden = d
@@ -769,7 +936,7 @@ class LSTMEvent(RecurrentLinearEvent):
                  n_epochs=10, dropout=0.50, l2_regularization=0.00,
                  batch_size=32, kernel_initializer='glorot_uniform', init_model=False, prior_log_prob=None,
                  reset_weights=False, batch_update=True, optimizer_kwargs=None, variance_prior_mode=None,
-                 variance_window=None):
+                 variance_window=None, replay_capacity=None, replay_mode='reservoir', update_scheduler=None):
 
         RecurrentLinearEvent.__init__(self, d, var_df0=var_df0, var_scale0=var_scale0, t=t,
                                       optimizer=optimizer, n_epochs=n_epochs,
@@ -777,7 +944,9 @@ class LSTMEvent(RecurrentLinearEvent):
                                       kernel_initializer=kernel_initializer, init_model=False,
                                       prior_log_prob=prior_log_prob, reset_weights=reset_weights,
                                       batch_update=batch_update, optimizer_kwargs=optimizer_kwargs,
-                                      variance_prior_mode=variance_prior_mode, variance_window=variance_window)
+                                      variance_prior_mode=variance_prior_mode, variance_window=variance_window,
+                                      replay_capacity=replay_capacity, replay_mode=replay_mode,
+                                      update_scheduler=update_scheduler)
 
         if n_hidden is None:
             self.n_hidden = d
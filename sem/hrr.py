@@ -18,20 +18,21 @@ def conv_circ(signal, kernal, n=None):
     Parameters
     ----------
 
-    signal: array of length D
+    signal: array of length D, or N x D array of signals
 
-    ker: array of length D
+    ker: array of length D, or N x D array of kernals
 
     Returns
     -------
 
-    array of length D
+    array of length D (or N x D), the convolution along the last axis
 
     '''
     if n == None:
-        n = len(signal) + len(kernal) - 1
+        n = np.shape(signal)[-1] + np.shape(kernal)[-1] - 1
 
-    return np.real(np.fft.ifft(np.fft.fft(signal, n) * np.fft.fft(kernal, n)))
+    # the inputs are real, so only the non-negative frequencies are needed
+    return np.fft.irfft(np.fft.rfft(signal, n) * np.fft.rfft(kernal, n), n)
 
 
 def plate_formula(n, k, err):
@@ -83,16 +84,234 @@ def embed(n, d, distr='spikeslab_gaussian', param=None):
 
 
 def encode(a, b):
-    return conv_circ(a, b, np.size(a))
+    # binds a and b along the last axis, both can be N x D arrays
+    return conv_circ(a, b, np.shape(a)[-1])
 
 
 def embed_onehot(n, d):
     v = np.zeros((n, d))
-    for ii in range(n):
-        v[ii][np.random.randint(d)] = 1
+    v[np.arange(n), np.random.randint(d, size=n)] = 1
     return v
 
 
 def decode(a, b):
-    c = np.real(np.fft.ifft(np.fft.fft(a, np.size(a)) * np.conj(np.fft.fft(b, np.size(a)))))
-    return c / np.size(a)
\ No newline at end of file
+    # unbinds b from a along the last axis, both can be N x D arrays
+    n = np.shape(a)[-1]
+    c = np.fft.irfft(np.fft.rfft(a, n) * np.conj(np.fft.rfft(b, n)), n)
+    return c / n
+
+
+class SpectrumCache(object):
+    """
+    Cache of the Fourier spectra of the roles (keys) of an HRR.  Binding or unbinding
+    with a cached role skips its forward transform, which is shared by every frame.
+
+    USAGE:
+        cache = SpectrumCache({'Agent': agent, 'Patient': patient})
+        x = cache.encode(fillers, 'Agent')  # fillers: N x D array
+        fillers_hat = cache.decode(x, 'Agent')
+    """
+
+    def __init__(self, keys=None):
+        """
+        :param keys: (optional) dict {name: D-length vector} of roles to cache
+        """
+        self.d = None
+        self.spectra = dict()
+        if keys is not None:
+            for name, key in keys.items():
+                self.add(name, key)
+
+    def add(self, name, key):
+        key = np.reshape(key, -1)
+        if self.d is None:
+            self.d = np.shape(key)[0]
+        assert np.shape(key)[0] == self.d
+        self.spectra[name] = np.fft.rfft(key, self.d)
+
+    def __contains__(self, name):
+        return name in self.spectra
+
+    def __getitem__(self, name):
+        return self.spectra[name]
+
+    def encode(self, a, name):
+        # equivalent to encode(a, key)
+        return np.fft.irfft(np.fft.rfft(a, self.d) * self.spectra[name], self.d)
+
+    def decode(self, a, name):
+        # equivalent to decode(a, key)
+        return np.fft.irfft(np.fft.rfft(a, self.d) * np.conj(self.spectra[name]), self.d) / self.d
+
+
+class CleanupMemory(object):
+    """
+    Cleanup memory over a vocabulary of embedded symbols.  Maps noisy vectors (e.g. the
+    output of decode) back to the most similar symbols, by cosine similarity, with a
+    single matrix multiply per batch of queries.
+
+    USAGE:
+        memory = CleanupMemory(embed_gaussian(d, n), names=symbols)
+        names, similarity = memory.query(decode(sentence, agent), k=3)
+    """
+
+    def __init__(self, vocab, names=None, chunk_size=None, path=None):
+        """
+        :param vocab: dict {name: D-length vector} or N x D array of embeddings (e.g. from
+                      embed or embed_gaussian).  Can be a memory-mapped array
+        :param names: (optional) the name of each row of an array vocabulary, defaults to
+                      the row index
+        :param chunk_size: (optional, int) compare the queries to chunk_size symbols at a time,
+                           for vocabularies too large to hold in memory at once
+        :param path: (optional, str) store the normalized vocabulary in a memory-mapped .npy
+                     file at path, instead of in memory
+        """
+        if isinstance(vocab, dict):
+            names = list(vocab.keys())
+            vocab = np.array([np.reshape(v, -1) for v in vocab.values()])
+        n, d = np.shape(vocab)
+        self.names = np.arange(n) if names is None else np.asarray(names)
+        assert len(self.names) == n
+        self.d = d
+        self.chunk_size = chunk_size
+
+        if path is None:
+            self.vectors = np.zeros((n, d))
+        else:
+            self.vectors = np.lib.format.open_memmap(path, mode='w+', dtype=float, shape=(n, d))
+
+        # store the normalized vectors, chunk-wise so the input can be memory-mapped
+        self.norms = np.zeros(n)
+        for lo, hi in self._chunks(n):
+            v = np.asarray(vocab[lo:hi], dtype=float)
+            self.norms[lo:hi] = np.linalg.norm(v, axis=1)
+            self.vectors[lo:hi] = v / np.maximum(self.norms[lo:hi], 1e-12).reshape(-1, 1)
+
+    def _normalize(self, x):
+        x = np.reshape(x, (-1, self.d))
+        return x / np.maximum(np.linalg.norm(x, axis=1), 1e-12).reshape(-1, 1)
+
+    def _chunks(self, n):
+        step = n if self.chunk_size is None else self.chunk_size
+        return [(lo, min(lo + step, n)) for lo in range(0, n, max(step, 1))]
+
+    def __len__(self):
+        return len(self.names)
+
+    def similarity(self, x):
+        """
+        :param x: D-length vector or M x D array of queries
+        :return: M x N array of cosine similarities to every symbol (not chunked)
+        """
+        x = self._normalize(x)
+        return np.dot(x, np.asarray(self.vectors).T)
+
+    def query(self, x, k=1):
+        """
+        :param x: D-length vector or M x D array of queries
+        :param k: (int, default 1) number of matches to return per query
+
+        :return: names, M x k array of the best matching symbols, most similar first
+                 similarity, M x k array of their cosine similarities
+                 (k-length arrays for a single query vector)
+        """
+        single = np.ndim(x) == 1
+        x = self._normalize(x)
+        k = min(k, len(self))
+
+        # keep a running top-k over the chunks of the vocabulary
+        best_idx = np.zeros((x.shape[0], 0), dtype=int)
+        best_sim = np.zeros((x.shape[0], 0))
+        for lo, hi in self._chunks(len(self)):
+            sim = np.concatenate([best_sim, np.dot(x, np.asarray(self.vectors[lo:hi]).T)], axis=1)
+            idx = np.concatenate([best_idx, np.tile(np.arange(lo, hi), (x.shape[0], 1))], axis=1)
+            top = np.argpartition(-sim, k - 1, axis=1)[:, :k]
+            best_sim = np.take_along_axis(sim, top, axis=1)
+            best_idx = np.take_along_axis(idx, top, axis=1)
+
+        order = np.argsort(-best_sim, axis=1)
+        best_sim = np.take_along_axis(best_sim, order, axis=1)
+        names = self.names[np.take_along_axis(best_idx, order, axis=1)]
+        if single:
+            return names[0], best_sim[0]
+        return names, best_sim
+
+
+class SceneEncoder(object):
+    """
+    Encodes a sequence of symbolic scenes as HRRs, producing the N x D input matrix of
+    SEM.run.  Each scene is the superposition of its bound (role, filler) pairs, e.g.
+
+        encoder = SceneEncoder(d)
+        x = encoder.encode([
+            {'Agent': 'Tom', 'Verb': 'Ask', 'Patient': 'Charan'},
+            {'Agent': 'Charan', 'Verb': 'Answer', 'Patient': 'Tom'},
+        ])
+
+    Roles and fillers that are not in the vocabulary are embedded the first time they
+    are seen.  The spectra of the roles and fillers are cached (see SpectrumCache), and all
+    of the scenes are bound and superposed in one batched pass.
+    """
+
+    def __init__(self, d, roles=None, fillers=None, embedding=None, normalize=True, dtype=np.float32):
+        """
+        :param d: (int) dimensions of the embedding
+        :param roles: (optional) dict {name: D-length vector}, pre-specified role vectors
+        :param fillers: (optional) dict {name: D-length vector}, pre-specified filler vectors
+        :param embedding: (optional) function (n, d) -> n x D array used to embed new symbols,
+                          defaults to embed_gaussian
+        :param normalize: (bool, default True) divide each scene by the square root of its
+                          number of bindings (as in (encode(a, b) + encode(c, d)) / np.sqrt(2))
+        :param dtype: (default np.float32) dtype of the encoded scenes
+        """
+        self.d = d
+        self.roles = dict() if roles is None else {k: np.reshape(v, -1) for k, v in roles.items()}
+        self.fillers = dict() if fillers is None else {k: np.reshape(v, -1) for k, v in fillers.items()}
+        if embedding is None:
+            def embedding(n, d):
+                return embed_gaussian(d, n)
+        self.embedding = embedding
+        self.normalize = normalize
+        self.dtype = dtype
+
+        self._role_spectra = SpectrumCache(self.roles)
+        self._filler_spectra = SpectrumCache(self.fillers)
+
+    def _embed_new(self, vocab, spectra, names):
+        # embeds the new symbols, and caches the spectra of the symbols that aren't cached yet
+        names = list(dict.fromkeys(names))
+        new_names = [name for name in names if name not in vocab]
+        if len(new_names) > 0:
+            for name, v in zip(new_names, self.embedding(len(new_names), self.d)):
+                vocab[name] = v
+        for name in names:
+            if name not in spectra:
+                spectra.add(name, vocab[name])
+
+    def encode(self, scenes):
+        """
+        :param scenes: list of scenes, each a dict {role: filler} or a list of (role, filler) pairs
+        :return: N x D array of the encoded scenes
+        """
+        pairs = [list(scene.items()) if isinstance(scene, dict) else list(scene) for scene in scenes]
+        scene_idx = np.array([ii for ii, scene in enumerate(pairs) for _ in scene], dtype=int)
+        role_names = [role for scene in pairs for (role, _) in scene]
+        filler_names = [filler for scene in pairs for (_, filler) in scene]
+
+        self._embed_new(self.roles, self._role_spectra, role_names)
+        self._embed_new(self.fillers, self._filler_spectra, filler_names)
+
+        # bind all of the pairs in the frequency domain and superpose them there (the transform
+        # is linear), so only one inverse transform is needed per scene
+        x_spectra = np.zeros((len(pairs), self.d // 2 + 1), dtype=complex)
+        if len(scene_idx) > 0:
+            roles = np.array([self._role_spectra[name] for name in role_names])
+            fillers = np.array([self._filler_spectra[name] for name in filler_names])
+            np.add.at(x_spectra, scene_idx, roles * fillers)
+        x = np.fft.irfft(x_spectra, self.d)
+
+        if self.normalize:
+            n_bindings = np.bincount(scene_idx, minlength=len(pairs))
+            x /= np.sqrt(np.maximum(n_bindings, 1)).reshape(-1, 1)
+
+        return x.astype(self.dtype)
@@ -1,10 +1,12 @@
 import numpy as np
 from tqdm import tqdm
-from scipy.stats import multivariate_normal as mvnorm
 from scipy.special import logsumexp
-from .utils import fast_mvnorm_diagonal_logprob
+from .utils import diagonal_mvnorm_logprob
 np.seterr(divide = 'ignore')
 import os
+import traceback
+import multiprocessing
+from queue import Empty
 os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE"
 
 def sample_pmf(pmf):
@@ -46,40 +48,117 @@ def get_scrp_prob(e, lmda, alfa):
 def reconstruction_accuracy(y_samples, y_mem):
     """
     
-    :param:     y_samples - list of y_samples
+    :param:     y_samples - n_samples x n np.array, the index of the item of y_mem drawn
+                for each timepoint of each sample (-1 for the null token).  A list of
+                samples of y_mem items is also accepted
     :param:     y_mem - original corrupted memory trace
 
     :return:    item_accuracy, list of probabilities each item in original memory 
                 is in the final reconstruction
 
-    # checked this function on 5/20/19, this function is correct if unintuitive
     """
+    n_orig = len(y_mem)
+    y_samples = as_y_sample_index(y_samples, y_mem)
 
+    # items are sampled without replacement, so each item appears at most once per sample
+    # and its accuracy is the fraction of samples that contain it
+    counts = np.bincount(y_samples[y_samples >= 0], minlength=n_orig)
+    return counts / float(np.shape(y_samples)[0])
 
-    acc = []
-    n_orig = len(y_mem)
 
-    for y_sample in y_samples:
+def as_y_sample_index(y_samples, y_mem):
+    """
+    convert samples of y_mem items into the index of the item drawn for each timepoint
 
-        def item_acc(t):
-            # loop through all of the items in the reconstruction trace, and compare them to 
-            # item t in the corrupted trace.  Return 1.0 if there is a match, zero otherwise
-            return np.float(any(
-                [np.array_equal(yt_samp[0], y_mem[t][0]) for yt_samp in y_sample if yt_samp != None]
-                ))
+    :param y_samples: list of samples of y_mem (or an n_samples x n integer np.array,
+                      returned as is)
+    :param y_mem: original corrupted memory trace
+
+    :return: n_samples x n np.array, -1 for the null token
+    """
+    if isinstance(y_samples, np.ndarray) and np.issubdtype(y_samples.dtype, np.integer):
+        return y_samples.reshape(-1, np.shape(y_samples)[-1])
 
-        # evaluate the accuracy for all of the items in the set
-        acc.append([item_acc(t) for t in range(n_orig)])
+    # match the items by their feature vectors
+    y_mem = as_memory_trace(y_mem)
+    item_index = {x_i.tobytes(): ii for ii, x_i in enumerate(y_mem.x)}
+    return np.array([
+        [-1 if y_t is None else item_index[np.asarray(y_t[0], dtype=float).reshape(-1).tobytes()] for y_t in y_sample]
+        for y_sample in y_samples
+    ], dtype=int)
 
-    # return the vector of accuracy
-    return np.mean(acc, axis=0)
 
 def evaluate_seg(e_samples, e_true):
-    acc = []
-    for e in e_samples:
-        acc.append(np.mean(np.array(e) == e_true))
-    return np.mean(acc)
-    
+    """
+    :param e_samples: n_samples x n np.array (or list) of sampled event labels
+    :param e_true: np.array of length n, true event labels
+
+    :return: mean agreement of the samples with e_true
+    """
+    return np.mean(np.asarray(e_samples) == np.reshape(e_true, (1, -1)))
+
+
+# label of memory items whose event label was not stored
+MISSING_LABEL = -1
+
+
+class MemoryTrace(object):
+    """
+    compact, struct-of-arrays representation of a corrupted memory trace
+
+        x: n x d np.array, corrupted feature vectors
+        e: np.array of n ints, event labels (MISSING_LABEL if not stored)
+        t: np.array of n ints, corrupted time indices
+
+    Indexing a trace with an int returns the item as a list [x_mem, e_mem, t_mem], with
+    e_mem = None for a missing label, as in the list representation.  Indexing with a
+    slice or an array returns a MemoryTrace of the selected items
+    """
+
+    def __init__(self, x, e, t):
+        self.x = np.asarray(x, dtype=float)
+        self.e = np.asarray(e, dtype=int)
+        self.t = np.asarray(t, dtype=int)
+        assert self.x.ndim == 2
+        assert self.e.shape == self.t.shape == (self.x.shape[0],)
+
+    @classmethod
+    def from_list(cls, y_mem):
+        """ :param y_mem: list of [x_mem, e_mem, t_mem] lists """
+        x = np.array([np.reshape(x_i, -1) for (x_i, _, _) in y_mem])
+        e = np.array([MISSING_LABEL if e_i is None else e_i for (_, e_i, _) in y_mem], dtype=int)
+        t = np.array([t_i for (_, _, t_i) in y_mem], dtype=int)
+        return cls(x, e, t)
+
+    def to_list(self):
+        return [self[ii] for ii in range(len(self))]
+
+    def __len__(self):
+        return self.x.shape[0]
+
+    def __getitem__(self, ii):
+        if not isinstance(ii, (int, np.integer)):
+            return MemoryTrace(self.x[ii], self.e[ii], self.t[ii])
+        e_i = None if self.e[ii] == MISSING_LABEL else self.e[ii]
+        return [self.x[ii], e_i, self.t[ii]]
+
+    def __repr__(self):
+        return 'MemoryTrace(n={}, d={},\n  e={},\n  t={})'.format(
+            len(self), self.x.shape[1], np.array2string(self.e, threshold=20), np.array2string(self.t, threshold=20)
+        )
+
+    def __iter__(self):
+        for ii in range(len(self)):
+            yield self[ii]
+
+
+def as_memory_trace(y_mem):
+    """ convert a list of [x_mem, e_mem, t_mem] items to a MemoryTrace, if needed """
+    if isinstance(y_mem, MemoryTrace):
+        return y_mem
+    return MemoryTrace.from_list(y_mem)
+
+
 def create_corrupted_trace(x, e, tau, epsilon_e, b, return_random_draws_of_p_e=False):
     """
     create a corrupted memory trace from feature vectors and event labels
@@ -90,98 +169,157 @@ def create_corrupted_trace(x, e, tau, epsilon_e, b, return_random_draws_of_p_e=F
     :param epsilon_e:   float, event label precision
     :param b:           int, time index corruption
 
-    :return y_mem: list of corrupted memory tuples:
+    :return y_mem: MemoryTrace, the corrupted memory trace
     """
 
     n, d = x.shape
 
-    # create the corrupted memory trace
-    y_mem = list()  # these are list, not sets, for hashability
-
     # pre-draw the uniform random numbers to determine the event-label corruption noise so that 
     # we can return them as needed.
-    e_noise_draws = [np.random.uniform(0, 1) for _ in range(n)]
+    e_noise_draws = np.random.uniform(0, 1, size=n)
+
+    x_mem = x + np.random.normal(scale=tau ** 0.5, size=(n, d))  # note, built in function uses stdev, not variance
+    e_mem = np.where(e_noise_draws < epsilon_e, e, MISSING_LABEL)
+    t_mem = np.arange(n) + np.random.randint(-b, b + 1, size=n)
+    y_mem = MemoryTrace(x_mem, e_mem, t_mem)
 
-    for t in range(n):
-        x_mem = x[t, :] + np.random.normal(scale=tau ** 0.5, size=d) # note, built in function uses stdev, not variance 
-        e_mem = [None, e[t]][e_noise_draws[t] < epsilon_e]
-        t_mem = t + np.random.randint(-b, b + 1)
-        y_mem.append([x_mem, e_mem, t_mem])
-    
     if return_random_draws_of_p_e:
         return y_mem, e_noise_draws
 
     return y_mem
 
-def init_y_sample(y_mem, b, epsilon):
+
+def index_trace_by_time(y_mem):
     """
-    :param y_mem: list of corrupted memory traces
+    index the memory trace by the corrupted time index, so that the items within the
+    time band of any timepoint are a contiguous slice of the index.  The index is
+    read-only and can be shared across Gibbs sweeps.
+
+    :param y_mem: MemoryTrace (or list of items), corrupted memory trace
+    :returns: order, np.array, position in y_mem of each item of the index
+              t_mem, np.array, the (sorted) time indices
+              x_mem, np.array (n x d), the feature vectors
+              e_mem, np.array, the event labels, MISSING_LABEL where the label is missing
+    """
+    y_mem = as_memory_trace(y_mem)
+    order = np.argsort(y_mem.t, kind='stable')
+    return order, y_mem.t[order], y_mem.x[order], y_mem.e[order]
+
+
+def time_band(t_mem, t, b):
+    """
+    :param t_mem: sorted np.array of memory time indices
+    :param t: int, timepoint
+    :param b: int, time index corruption noise
+    :returns: lo, hi -- the slice of t_mem with |t_mem - t| <= b
+    """
+    return np.searchsorted(t_mem, t - b, side='left'), np.searchsorted(t_mem, t + b, side='right')
+
+
+def init_y_sample(y_mem, b, epsilon, trace_index=None):
+    """
+    :param y_mem: MemoryTrace (or list of items), corrupted memory trace
     :param b: time corruption noise
     :param epsilon: "forgetting" parameter 
-    :returns: sample of y_mem
+    :param trace_index: (optional) output of index_trace_by_time(y_mem)
+    :returns: sample of y_mem, np.array of length n of the index of the item of y_mem
+              drawn for each timepoint, -1 for the null token
     """
     n_t = len(y_mem)
-    y_sample = [None] * n_t
+    y_sample = np.zeros(n_t, dtype=int) - 1
+
+    if trace_index is None:
+        trace_index = index_trace_by_time(y_mem)
+    order, t_mem, _, _ = trace_index
 
-    # create a copy of y_mem for sampling without replacement
-    y_mem_copy = [[x_i.copy(), e_i, t_mem] for (x_i, e_i, t_mem) in y_mem]
+    # sample without replacement by masking out the items already drawn
+    available = np.ones(len(order), dtype=bool)
 
     # loop through timepoints in a random order
     for t in np.random.permutation(range(n_t)):
 
-        # create a probability function over the sample sets
-        log_p = np.zeros(len(y_mem_copy) + 1) - np.inf
-        for ii, (x_i, e_i, t_mem) in enumerate(y_mem_copy):
-            if np.abs(t_mem - t) <= b:
-                log_p[ii] = 0
-                # draw a sample
+        # only the available items within the time band can be drawn, all of them uniformly
+        lo, hi = time_band(t_mem, t, b)
+        candidates = lo + np.flatnonzero(available[lo:hi])
+        log_p = np.zeros(len(candidates) + 1)
         log_p[-1] = np.log(epsilon)
         p = np.exp(log_p - logsumexp(log_p))  # normalize and exponentiate
 
         ii = sample_pmf(p)
 
-        if ii < len(y_mem_copy):
+        if ii < len(candidates):
             # only create a sample for none-None events
-            y_sample[t] = y_mem_copy[ii]
-            y_mem_copy = y_mem_copy[:ii] + y_mem_copy[ii + 1:]  # remove the item from the list of available
+            y_sample[t] = order[candidates[ii]]
+            available[candidates[ii]] = False  # remove the item from the set of available
     return y_sample
 
 
-def init_x_sample_cond_y(y_sample, n, d, tau):
+def init_x_sample_cond_y(y_sample, n, d, tau, y_mem=None):
+    """
+    :param y_sample: sample of y_mem, either the index of the item of y_mem drawn for each
+                     timepoint (-1 for the null token), or without y_mem, the item itself
+                     (None for the null token)
+    :param y_mem: (optional) MemoryTrace (or list of items) that y_sample indexes
+    """
     x_sample = np.random.randn(n, d) * tau
 
-    for ii, y_ii in enumerate(y_sample):
-        if y_ii is not None:
-            x_sample[ii, :] = y_ii[0]
+    if y_mem is None:
+        for ii, y_ii in enumerate(y_sample):
+            if y_ii is not None:
+                x_sample[ii, :] = y_ii[0]
+        return x_sample
+
+    y_mem = as_memory_trace(y_mem)
+    has_y = y_sample >= 0
+    x_sample[has_y, :] = y_mem.x[y_sample[has_y], :]
     return x_sample
 
 
-def sample_y_given_x_e(y_mem, x, e, b, tau, epsilon):
+def sample_y_given_x_e(y_mem, x, e, b, tau, epsilon, trace_index=None):
+    """
+    :param y_mem: MemoryTrace (or list of items), corrupted memory trace
+    :param x: n x d np.array, sample of the features
+    :param e: np.array of length n, sample of the event labels
+    :param b: time corruption noise
+    :param tau: feature corruption noise
+    :param epsilon: "forgetting" parameter
+    :param trace_index: (optional) output of index_trace_by_time(y_mem)
+    :returns: sample of y_mem, np.array of length n of the index of the item of y_mem
+              drawn for each timepoint, -1 for the null token
+    """
     # total number of samples
     n, d = np.shape(x)
 
-    #
-    y_sample = [None] * n
+    # index of the item of y_mem drawn for each timepoint, -1 for the null token
+    y_sample = np.zeros(n, dtype=int) - 1
 
-    # create a copy of y_mem for sampling without replacement
-    y_mem_copy = [[x_i.copy(), e_i, t_mem] for (x_i, e_i, t_mem) in y_mem]
+    if trace_index is None:
+        trace_index = index_trace_by_time(y_mem)
+    order, t_mem, x_mem, e_mem = trace_index
 
-    _ones = np.ones(d)
+    # sample without replacement by masking out the items already drawn
+    available = np.ones(len(order), dtype=bool)
+
+    # the memory corruption noise is the same for every item
+    tau_inv = np.ones(d) / tau
+    tau_log_det = d * np.log(tau)
 
     for t in np.random.permutation(range(n)):
 
+        # only the available items within the time band can match the timepoint
+        lo, hi = time_band(t_mem, t, b)
+        candidates = lo + np.flatnonzero(available[lo:hi])
+
         # create a probability function over the sample sets
-        log_p = np.zeros(len(y_mem_copy) + 1) - np.inf
-        for ii, (x_i, e_i, t_mem) in enumerate(y_mem_copy):
-            if np.abs(t_mem - t) <= b:
-                # because we alwasy assume the covariance function is diagonal, we can use the
-                # univariate normal to speed up the calculations
-                log_p[ii] = fast_mvnorm_diagonal_logprob(x_i.reshape(-1) - x[t, :].reshape(-1), _ones * tau)
+        log_p = np.zeros(len(candidates) + 1)
+        if len(candidates) > 0:
+            # because we alwasy assume the covariance function is diagonal, we can use the
+            # univariate normal to speed up the calculations
+            log_p[:-1] = diagonal_mvnorm_logprob(x_mem[candidates] - x[t, :].reshape(1, -1), tau_inv, tau_log_det)
 
             # set probability to zero if event token doesn't match
-            if e_i is not None:
-                if e_i != e[ii]:
-                    log_p[ii] -= np.inf
+            e_i = e_mem[candidates]
+            log_p[:-1][(e_i != MISSING_LABEL) & (e_i != e[t])] = -np.inf
 
         # the last token is always the null token
         log_p[-1] = np.log(epsilon)
@@ -190,16 +328,37 @@ def sample_y_given_x_e(y_mem, x, e, b, tau, epsilon):
         # draw a sample
         ii = sample_pmf(p)
 
-        if ii < len(y_mem_copy):
+        if ii < len(candidates):
             # only create a sample for none-None events
-            y_sample[t] = y_mem_copy[ii]
-            y_mem_copy = y_mem_copy[:ii] + y_mem_copy[ii + 1:]  # remove the item from the list of available
+            y_sample[t] = order[candidates[ii]]
+            available[candidates[ii]] = False  # remove the item from the set of available
 
     return y_sample
 
 
-def sample_e_given_x_y(x, y, event_models, alpha, lmda):
+def _stack_event_models(event_models, d):
+    """
+    :return: f0, k x d array of the predicted initial scene of each event model
+             sigma_inv, k x d array of the inverse of their (diagonal) variances
+             sigma_log_det, k-length array of the log-determinant of their variances
+    """
+    k = len(event_models)
+    f0 = np.zeros((k, d))
+    sigma_inv = np.ones((k, d))
+    sigma_log_det = np.zeros(k)
+    for idx, e_model in event_models.items():
+        f0[idx, :] = np.reshape(e_model.predict_f0(), -1)
+        sigma_inv[idx, :] = e_model.Sigma_inv
+        sigma_log_det[idx] = e_model.Sigma_log_det
+    return f0, sigma_inv, sigma_log_det
+
+
+def sample_e_given_x_y(x, y, y_mem, event_models, alpha, lmda):
     n, d = np.shape(x)
+    y_mem = as_memory_trace(y_mem)
+
+    # the event label stored with the memory item of each timepoint
+    e_y = np.where(y >= 0, y_mem.e[y], MISSING_LABEL)
 
     # define a special case of the sCRP that caps the number
     # of clusters at k, the number of event models
@@ -207,19 +366,21 @@ def sample_e_given_x_y(x, y, event_models, alpha, lmda):
     c = np.zeros(k)
 
     e_prev = None
-    e_sample = [None] * n
+    e_sample = np.zeros(n, dtype=int)
+
+    # the event models are frozen during sampling, so the predictions of the initial
+    # scenes and the variances of all the models can be cached in k x d arrays
+    f0, sigma_inv, sigma_log_det = _stack_event_models(event_models, d)
 
-    # keep a list of all the previous scenes within the sampled event
-    x_current = np.zeros((1, d))
+    # the previous scenes within the sampled event are x[token_start:t]
+    token_start = 0
 
     # do this as a filtering operation, just via a forward sweep
     for t in range(n):
 
         # first see if there is a valid memory token with a event label
-        if (y[t] is not None) and (y[t][1] is not None):
-            e_sample[t] = y[t][1]
-            e_prev = e_sample[t]
-            c[e_sample[t]] += 1
+        if e_y[t] != MISSING_LABEL:
+            e_sample[t] = e_y[t]
         else:
 
             # calculate the CRP prior
@@ -232,16 +393,15 @@ def sample_e_given_x_y(x, y, event_models, alpha, lmda):
                 p_sCRP[p_sCRP == 0] = alpha / np.sum(p_sCRP == 0)
             # no need to normalize yet
 
-            # calculate the probability of x_t|x_{1:t-1}
-            p_model = np.zeros(k) - np.inf
-            for idx, e_model in event_models.items():
-                if idx != e_prev:
-                    x_t_hat = e_model.predict_next_generative(x_current)
-                else:
-                    x_t_hat = e_model.predict_f0()
-                # because we alwasy assume the covariance function is diagonal, we can use the
-                # univariate normal to speed up the calculations
-                p_model[idx] = fast_mvnorm_diagonal_logprob(x[t, :] - x_t_hat.reshape(-1), e_model.Sigma)
+            # calculate the probability of x_t|x_{1:t-1}.  Every model but the current one
+            # starts a new event, only the current event model needs a new prediction
+            x_t_hat = f0.copy()
+            if e_prev in event_models:
+                x_t_hat[e_prev, :] = np.reshape(event_models[e_prev].predict_next_generative(x[token_start:t, :]), -1)
+
+            # because we alwasy assume the covariance function is diagonal, we can use the
+            # univariate normal to speed up the calculations
+            p_model = diagonal_mvnorm_logprob(x[t, :].reshape(1, -1) - x_t_hat, sigma_inv, sigma_log_det)
 
             log_p = p_model + np.log(p_sCRP)
             log_p -= logsumexp(log_p)
@@ -249,11 +409,9 @@ def sample_e_given_x_y(x, y, event_models, alpha, lmda):
             # draw from the model
             e_sample[t] = sample_pmf(np.exp(log_p))
 
-            # update counters
-            if e_prev == e_sample[t]:
-                x_current = np.concatenate([x_current, x[t, :].reshape(1, -1)])
-            else:
-                x_current = x[t, :].reshape(1, -1)
+        # update the start of the current event
+        if e_prev != e_sample[t]:
+            token_start = t
         e_prev = e_sample[t]
 
         # update the counts!
@@ -262,14 +420,106 @@ def sample_e_given_x_y(x, y, event_models, alpha, lmda):
     return e_sample
 
 
-def sample_x_given_y_e(x_hat, y, e, event_models, tau):
+def sample_e_given_x_y_blocked(x, y, y_mem, event_models, alpha, lmda, e_sample=None):
+    """
+    draw the whole sequence of event labels jointly, with forward-filtering
+    backward-sampling (FFBS)
+
+    The sCRP is approximated as a sticky Markov chain over the event models, with the counts
+    held fixed at those of the previous sample of the labels (e_sample).  The augmented
+    state at each timepoint pairs the event label with the label of the previous scene:
+    staying in the same event predicts the scene from the preceding scenes, and changing
+    events predicts the initial scene of the new event.
+
+    N.B. the prediction for staying in an event is conditioned on the preceding scenes,
+    regardless of their labels.  This is exact for markov (LDS) event models, but an
+    approximation for recurrent models near the start of an event
+
+    :param x: n x d np.array, sample of the features
+    :param y: np.array of length n, index of the memory item at each timepoint (-1 for null)
+    :param y_mem: MemoryTrace (or list of items), corrupted memory trace
+    :param event_models: dict {token: model}, trained event models
+    :param alpha: float, sCRP concentration parameter
+    :param lmda: float, sCRP stickiness parameter
+    :param e_sample: (optional) previous sample of the event labels, used for the sCRP counts
+
+    :return: np.array of length n, sample of the event labels
+    """
+    n, d = np.shape(x)
+    y_mem = as_memory_trace(y_mem)
+    k = len(event_models)
+
+    # the event label stored with the memory item of each timepoint
+    e_y = np.where(y >= 0, y_mem.e[y], MISSING_LABEL)
+
+    # sCRP counts, held fixed for the sweep
+    c = np.zeros(k)
+    if e_sample is not None:
+        c += np.bincount(np.asarray(e_sample, dtype=int), minlength=k)[:k]
+
+    def scrp(p_sCRP):
+        # add the alpha value to the unvisited clusters (as in sample_e_given_x_y)
+        p_sCRP = p_sCRP.copy()
+        if any(p_sCRP == 0):
+            p_sCRP[p_sCRP == 0] = alpha / np.sum(p_sCRP == 0)
+        return np.log(p_sCRP / np.sum(p_sCRP))
+
+    log_pi = scrp(c)
+    log_trans = np.array([scrp(c + lmda * (np.arange(k) == ii)) for ii in range(k)])  # k x k, rows: from, cols: to
+
+    # log-likelihood of each scene, under every model, starting a new event (f0) or
+    # continuing the current one (next), with a single batched prediction per model
+    f0, sigma_inv, sigma_log_det = _stack_event_models(event_models, d)
+    log_f0 = diagonal_mvnorm_logprob(x.reshape(n, 1, d) - f0.reshape(1, k, d), sigma_inv, sigma_log_det)
+    log_next = np.zeros((n, k)) - np.inf
+    if n > 1:
+        x_next = np.zeros((n - 1, k, d))
+        for idx, e_model in event_models.items():
+            x_next[:, idx, :] = np.reshape(e_model.predict_next_generative_batch(x[:-1, :]), (n - 1, d))
+        log_next[1:, :] = diagonal_mvnorm_logprob(x[1:, :].reshape(n - 1, 1, d) - x_next, sigma_inv, sigma_log_det)
+
+    def log_factor(t):
+        # k x k log-potential of the transition into timepoint t
+        log_lik = np.tile(log_f0[t, :], (k, 1))
+        log_lik[np.diag_indices(k)] = log_next[t, :]
+        return log_trans + log_lik
+
+    def clamp(log_p, t):
+        # timepoints with a labeled memory item are fixed to that label
+        if e_y[t] != MISSING_LABEL:
+            mask = np.ones(k, dtype=bool)
+            mask[e_y[t]] = False
+            log_p[mask] = -np.inf
+        return log_p
+
+    # forward filtering
+    log_alpha = np.zeros((n, k))
+    log_alpha[0, :] = clamp(log_pi + log_f0[0, :], 0)
+    for t in range(1, n):
+        log_alpha[t, :] = clamp(logsumexp(log_alpha[t - 1, :].reshape(-1, 1) + log_factor(t), axis=0), t)
+
+    # backward sampling
+    e_out = np.zeros(n, dtype=int)
+    log_p = log_alpha[-1, :]
+    e_out[-1] = sample_pmf(np.exp(log_p - logsumexp(log_p)))
+    for t in range(n - 2, -1, -1):
+        log_p = log_alpha[t, :] + log_factor(t + 1)[:, e_out[t + 1]]
+        e_out[t] = sample_pmf(np.exp(log_p - logsumexp(log_p)))
+
+    return e_out
+
+
+def sample_x_given_y_e(x_hat, y, y_mem, e, event_models, tau):
     """
     x_hat: n x d np.array
         the previous sample, to be updated and returned
 
-    y: list
-        the sequence of ordered memory traces. Each element is
-        either a list of [x_y_mem, t_mem] or None
+    y: np.array of length n
+        the sequence of ordered memory traces, as the index of the item
+        of y_mem at each timepoint (-1 for the null token)
+
+    y_mem: MemoryTrace (or list of items)
+        the corrupted memory trace
 
     e: np.array of length n
         the sequence of event tokens
@@ -284,49 +534,145 @@ def sample_x_given_y_e(x_hat, y, e, event_models, tau):
 
     # total number of samples
     n, d = np.shape(x_hat)
+    y_mem = as_memory_trace(y_mem)
 
     x_hat = x_hat.copy()  # don't want to overwrite the thing outside the loop...
+    e = np.asarray(e)
 
     # Note: this a filtering operation as the backwards pass is computationally difficult. 
     # (by this, we mean that sampling from  Pr(x_t| x_{t+1:n}, x_{1:t-1}, theta, e, y_mem) is intractable
     # and we thus only sample from Pr(x_t|, x_{1:t-1}, theta, e, y_mem), which is is Gaussian)
-    for t in np.random.permutation(range(n)):
+    #
+    # All of the scenes of an event are resampled as a block, conditioned on the previous
+    # estimates of x, so that each event model only makes a single (batched) prediction per sweep
+    for e0 in np.unique(e):
         # pull the active event model
-        e_model = event_models[e[t]]
+        e_model = event_models[e0]
+
+        # pull all of the scenes within the event, in order
+        x_idx = np.flatnonzero(e == e0)
 
-        # pull all preceding scenes within the event
-        x_idx = np.arange(len(e))[(e == e[t]) & (np.arange(len(e)) < t)]
+        # the prediction of each scene is conditioned on the preceding scenes within the event
         x_prev = np.concatenate([
-            np.zeros((1, d)), x_hat[x_idx, :]
+            np.zeros((1, d)), x_hat[x_idx[:-1], :]
         ])
+        f_x = np.reshape(e_model.predict_next_generative_batch(x_prev), (len(x_idx), d))
 
-        # pull the prediction of the event model given the previous estimates of x
-        f_x = e_model.predict_next_generative(x_prev)
+        # null tags keep the model prediction
+        x_bar = f_x
+        sigmas = np.tile(e_model.Sigma, (len(x_idx), 1))
+
+        # otherwise, combine the prediction with the memory trace
+        has_y = y[x_idx] >= 0
+        if np.any(has_y):
+            y_x = y_mem.x[y[x_idx[has_y]], :]
 
-        # is y_t a null tag?
-        if y[t] is None:
-            x_bar = f_x
-            sigmas = e_model.Sigma
-        else:
             # calculate noise lambda for each event model
             u_weight = (1. / e_model.Sigma) / (1. / e_model.Sigma + 1. / tau)
 
-            x_bar = u_weight * f_x + (1 - u_weight) * y[t][0]
-            sigmas = 1. / (1. / e_model.Sigma + 1. / tau)
+            x_bar[has_y, :] = u_weight * f_x[has_y, :] + (1 - u_weight) * y_x
+            sigmas[has_y, :] = 1. / (1. / e_model.Sigma + 1. / tau)
 
-        # draw a new sample of x_t 
-        # N.B. Handcoding a function to draw random variables introduced error into the algorithm
-        # and didn't save _any_ time.
-        x_hat[t, :] = mvnorm.rvs(mean=x_bar.reshape(-1), cov=np.diag(sigmas))
+        # draw a new sample of x, the covariance is diagonal so each dimension is independent
+        x_hat[x_idx, :] = x_bar + np.sqrt(sigmas) * np.random.normal(size=(len(x_idx), d))
 
     return x_hat
 
 
+def _trained_event_models(sem_model):
+    # the sampler considers every event type, including the ones retired to disk
+    if getattr(sem_model, 'retired_models', None):
+        sem_model.restore_event_models()
+    return {
+        k: v for k, v in sem_model.event_models.items() if v.f_is_trained
+    }
+
+
+def _sample_e(x_sample, y_sample, y_mem, event_models, memory_alpha, memory_lambda, e_sampler, e_sample=None):
+    if e_sampler == 'blocked':
+        return sample_e_given_x_y_blocked(x_sample, y_sample, y_mem, event_models, memory_alpha, memory_lambda,
+                                          e_sample=e_sample)
+    elif e_sampler == 'forward':
+        return sample_e_given_x_y(x_sample, y_sample, y_mem, event_models, memory_alpha, memory_lambda)
+    raise ValueError("e_sampler must be 'forward' or 'blocked', not {}".format(e_sampler))
+
+
+def _init_gibbs_sample(y_mem, event_models, memory_alpha, memory_lambda, memory_epsilon, b, tau, trace_index,
+                       e_sampler):
+    n, d = np.shape(y_mem.x)
+
+    y_sample = init_y_sample(y_mem, b, memory_epsilon, trace_index=trace_index)
+    x_sample = init_x_sample_cond_y(y_sample, n, d, tau, y_mem=y_mem)
+    e_sample = _sample_e(x_sample, y_sample, y_mem, event_models, memory_alpha, memory_lambda, e_sampler)
+    return y_sample, e_sample, x_sample
+
+
+def _gibbs_sweep(y_mem, y_sample, e_sample, x_sample, event_models, memory_alpha, memory_lambda, memory_epsilon,
+                 b, tau, trace_index, e_sampler):
+    # sample the memory features
+    x_sample = sample_x_given_y_e(x_sample, y_sample, y_mem, e_sample, event_models, tau)
+
+    # sample the event models
+    e_sample = _sample_e(x_sample, y_sample, y_mem, event_models, memory_alpha, memory_lambda, e_sampler,
+                         e_sample=e_sample)
+
+    # sample the memory traces
+    y_sample = sample_y_given_x_e(y_mem, x_sample, e_sample, b, tau, memory_epsilon, trace_index=trace_index)
+
+    return y_sample, e_sample, x_sample
+
+
+class GibbsSummary(object):
+    """
+    running (online) estimates over the Gibbs samples, so the samples themselves
+    don't need to be stored:
+
+        x_mean, x_var:   n x d arrays, posterior mean and variance of the features
+        e_marginals:     n x k array, posterior probability of each event label
+        item_recall:     probability each item of the memory trace is in the reconstruction
+    """
+
+    def __init__(self, n, d, k, n_mem):
+        self.n_samples = 0
+        self.x_mean = np.zeros((n, d))
+        self._x_m2 = np.zeros((n, d))  # running sum of squared deviations (Welford's algorithm)
+        self._e_counts = np.zeros((n, k))
+        self._item_counts = np.zeros(n_mem)
+
+    def update(self, y_sample, e_sample, x_sample):
+        """
+        :param y_sample: np.array of length n, the index of the memory item drawn
+                         for each timepoint, -1 for the null token
+        :param e_sample: event labels of the sample
+        :param x_sample: n x d array, features of the sample
+        """
+        self.n_samples += 1
+        delta = x_sample - self.x_mean
+        self.x_mean += delta / self.n_samples
+        self._x_m2 += delta * (x_sample - self.x_mean)
+
+        self._e_counts[np.arange(len(e_sample)), np.asarray(e_sample, dtype=int)] += 1
+        self._item_counts[y_sample[y_sample >= 0]] += 1
+
+    @property
+    def x_var(self):
+        return self._x_m2 / max(self.n_samples - 1, 1)
+
+    @property
+    def e_marginals(self):
+        return self._e_counts / max(self.n_samples, 1)
+
+    @property
+    def item_recall(self):
+        return self._item_counts / max(self.n_samples, 1)
+
+
 def gibbs_memory_sampler(y_mem, sem_model, memory_alpha, memory_lambda, memory_epsilon, b, tau,
-                         n_samples=100, n_burnin=25, progress_bar=True, leave_progress_bar=True):
+                         n_samples=100, n_burnin=25, progress_bar=True, leave_progress_bar=True,
+                         thin=1, store_samples=True, sample_path=None, return_summary=False, e_sampler='forward'):
     """
 
-    :param y_mem: list of 3-tuples (x_mem, e_mem, t_mem), corrupted memory trace
+    :param y_mem: MemoryTrace (or list of 3-tuples (x_mem, e_mem, t_mem)), corrupted memory trace
     :param sem_mdoel: trained SEM instance
     :param memory_alpha: SEM alpha parameter to use in reconstruction
     :param memory_labmda: SEM lmbda parameter to use in reconstruction
@@ -334,28 +680,56 @@ def gibbs_memory_sampler(y_mem, sem_model, memory_alpha, memory_lambda, memory_e
     :param b: (int) time index corruption noise
     :param tau: (float, greater than zero) feature vector corruption noise
     :param n_burnin: (int, default 25) number of Gibbs sampling itterations to burn in
-    :param n_samples: (int, default 100) number of Gibbs sampling itterations to collect
+    :param n_samples: (int, default 100) number of Gibbs samples to collect
     :param progress_bar: (bool) use progress bar for sampling?
     :param leave_progress_bar: (bool, default=True) leave the progress bar at the end? 
-
-    :return: y_samples, e_samples, x_samples - Gibbs samples
+    :param thin: (int, default 1) keep every thin-th itteration after burn in, for a total of
+                 n_burnin + n_samples * thin itterations
+    :param store_samples: (bool, default True) keep the samples in memory? If False, the returned
+                          samples are None and only the online summary (and sample_path) are kept
+    :param sample_path: (optional) str, stream the raw samples to the memory-mappable files
+                        sample_path + '_x.npy', '_e.npy' and '_y.npy' (index of the memory item
+                        drawn for each timepoint, -1 for the null token)
+    :param return_summary: (bool, default False) also return a GibbsSummary of the samples
+    :param e_sampler: (str, default 'forward') sampler of the event labels, either 'forward' (forward
+                      filtering, see sample_e_given_x_y) or 'blocked' (the whole sequence jointly, see
+                      sample_e_given_x_y_blocked), which mixes in far fewer itterations
+
+    :return: y_samples, e_samples, x_samples - Gibbs samples, as n_samples x n, n_samples x n and
+             n_samples x n x d np.arrays. y_samples is the index of the item of y_mem drawn for each
+             timepoint (-1 for the null token)
+             (and summary, a GibbsSummary, if return_summary)
     """
 
-    event_models =  {
-        k: v for k, v in sem_model.event_models.items() if v.f_is_trained
-    }
+    event_models = _trained_event_models(sem_model)
 
-    d = np.shape(y_mem[0][0])[0]
-    n = len(y_mem)
+    y_mem = as_memory_trace(y_mem)
+    n, d = np.shape(y_mem.x)
 
     #
-    e_samples = [None] * n_samples
-    y_samples = [None] * n_samples
-    x_samples = [None] * n_samples
+    if store_samples:
+        e_samples = np.zeros((n_samples, n), dtype=int)
+        y_samples = np.zeros((n_samples, n), dtype=int)
+        x_samples = np.zeros((n_samples, n, d))
+    else:
+        e_samples, y_samples, x_samples = None, None, None
+
+    summary = GibbsSummary(n, d, max(event_models.keys()) + 1, n)
+
+    if sample_path is not None:
+        x_file = np.lib.format.open_memmap(sample_path + '_x.npy', mode='w+', dtype=float, shape=(n_samples, n, d))
+        e_file = np.lib.format.open_memmap(sample_path + '_e.npy', mode='w+', dtype=int, shape=(n_samples, n))
+        y_file = np.lib.format.open_memmap(sample_path + '_y.npy', mode='w+', dtype=int, shape=(n_samples, n))
+
+    # index the memory trace once, it is shared by all of the sweeps
+    trace_index = index_trace_by_time(y_mem)
 
-    y_sample = init_y_sample(y_mem, b, memory_epsilon)
-    x_sample = init_x_sample_cond_y(y_sample, n, d, tau)
-    e_sample = sample_e_given_x_y(x_sample, y_sample, event_models, memory_alpha, memory_lambda)
+    gibbs_kwargs = dict(
+        event_models=event_models, memory_alpha=memory_alpha, memory_lambda=memory_lambda,
+        memory_epsilon=memory_epsilon, b=b, tau=tau, trace_index=trace_index, e_sampler=e_sampler
+    )
+
+    y_sample, e_sample, x_sample = _init_gibbs_sample(y_mem, **gibbs_kwargs)
 
     # loop through the other events in the list
     if progress_bar:
@@ -365,52 +739,297 @@ def gibbs_memory_sampler(y_mem, sem_model, memory_alpha, memory_lambda, memory_e
         def my_it(iterator):
             return iterator
     
-    for ii in my_it(range(n_burnin + n_samples)):
+    for ii in my_it(range(n_burnin + n_samples * thin)):
+
+        y_sample, e_sample, x_sample = _gibbs_sweep(y_mem, y_sample, e_sample, x_sample, **gibbs_kwargs)
 
-        # sample the memory features
-        x_sample = sample_x_given_y_e(x_sample, y_sample, e_sample, event_models, tau)
+        if (ii >= n_burnin) and ((ii - n_burnin) % thin == 0):
+            jj = (ii - n_burnin) // thin
+            summary.update(y_sample, e_sample, x_sample)
 
-        # sample the event models
-        e_sample = sample_e_given_x_y(x_sample, y_sample, event_models, memory_alpha, memory_lambda)
+            if store_samples:
+                e_samples[jj] = e_sample
+                y_samples[jj] = y_sample
+                x_samples[jj] = x_sample
 
-        # sample the memory traces
-        y_sample = sample_y_given_x_e(y_mem, x_sample, e_sample, b, tau, memory_epsilon)
+            if sample_path is not None:
+                x_file[jj] = x_sample
+                e_file[jj] = e_sample
+                y_file[jj] = y_sample
 
-        if ii >= n_burnin:
-            e_samples[ii - n_burnin] = e_sample
-            y_samples[ii - n_burnin] = y_sample
-            x_samples[ii - n_burnin] = x_sample
+    if sample_path is not None:
+        for f in [x_file, e_file, y_file]:
+            f.flush()
+        del x_file, e_file, y_file
 
+    if return_summary:
+        return y_samples, e_samples, x_samples, summary
     return y_samples, e_samples, x_samples
 
-## there appears to be something wrong with this function! do not use for now
-# def multichain_gibbs(y_mem, sem_model, memory_alpha, memory_lambda, memory_epsilon, b, tau, n_chains=2,
-#                          n_samples=250, n_burnin=50, progress_bar=True, leave_progress_bar=True):
-
-#     """
-
-#     :param y_mem: list of 3-tuples (x_mem, e_mem, t_mem), corrupted memory trace
-#     :param sem_mdoel: trained SEM instance
-#     :param memory_alpha: SEM alpha parameter to use in reconstruction
-#     :param memory_labmda: SEM lmbda parameter to use in reconstruction
-#     :param memory_epsilon: (float) parameter controlling propensity to include null trace in reconstruction
-#     :param b: (int) time index corruption noise
-#     :param tau: (float, greater than zero) feature vector corruption noise
-#     :param n_burnin: (int, default 100) number of Gibbs sampling itterations to burn in
-#     :param n_samples: (int, default 250) number of Gibbs sampling itterations to collect
-#     :param progress_bar: (bool) use progress bar for sampling?
-#     :param leave_progress_bar: (bool, default=True) leave the progress bar at the end? 
-
-#     :return: y_samples, e_samples, x_samples - Gibbs samples
-#     """
-
-#     y_samples, e_samples, x_samples = [], [], []
-#     for _ in range(n_chains):
-#         _y0, _e0, _x0 = gibbs_memory_sampler(
-#             y_mem, sem_model, memory_alpha, memory_lambda, memory_epsilon, 
-#             b, tau, n_samples, progress_bar, False, leave_progress_bar
-#             )
-#         y_samples += _y0
-#         e_samples += _e0
-#         x_samples += _x0
-#     return y_samples, e_samples, x_samples
\ No newline at end of file
+
+def gelman_rubin(chains):
+    """
+    split-chain potential scale reduction factor (R-hat) of a scalar statistic
+    (see Gelman, et al., Bayesian Data Analysis 2013)
+
+    :param chains: m x n np.array, n draws of the statistic in each of m chains
+    :return: float, R-hat. Values close to 1 indicate the chains have converged
+    """
+    chains = np.asarray(chains, dtype=float)
+    half = np.shape(chains)[1] // 2
+    if half < 2:
+        return np.inf
+
+    # split each chain in half to also detect non-stationarity within a chain
+    split = np.concatenate([chains[:, :half], chains[:, half:2 * half]], axis=0)
+
+    w = np.mean(np.var(split, axis=1, ddof=1))  # within-chain variance
+    b = half * np.var(np.mean(split, axis=1), ddof=1)  # between-chain variance
+    if w == 0:
+        return 1.0 if b == 0 else np.inf
+
+    var_plus = (half - 1.) / half * w + b / half
+    return np.sqrt(var_plus / w)
+
+
+def effective_sample_size(chains):
+    """
+    multi-chain effective sample size of a scalar statistic, using the autocorrelations
+    truncated at the first negative pair (Geyer's initial positive sequence, see
+    Gelman, et al., Bayesian Data Analysis 2013)
+
+    :param chains: m x n np.array, n draws of the statistic in each of m chains
+    :return: float, effective number of independent draws
+    """
+    chains = np.asarray(chains, dtype=float)
+    m, n = np.shape(chains)
+    if n < 4:
+        return float(m * n)
+
+    w = np.mean(np.var(chains, axis=1, ddof=1))
+    var_plus = (n - 1.) / n * w + np.var(np.mean(chains, axis=1), ddof=1) if m > 1 else w
+    if var_plus == 0:
+        return float(m * n)
+
+    # autocovariance of each chain via the FFT
+    centered = chains - np.mean(chains, axis=1, keepdims=True)
+    f = np.fft.rfft(centered, n=2 * n, axis=1)
+    acov = np.fft.irfft(f * np.conj(f), n=2 * n, axis=1)[:, :n] / n
+    rho = 1. - (w - np.mean(acov, axis=0)) / var_plus
+
+    # sum the autocorrelations in pairs, until the first negative pair, keeping
+    # the sequence of pairs monotone to reduce the noise of the estimate
+    tau, prev_pair = -1., np.inf
+    for t in range(0, n - 1, 2):
+        pair = min(rho[t] + rho[t + 1], prev_pair)
+        if pair < 0:
+            break
+        tau += 2 * pair
+        prev_pair = pair
+    return m * n / max(tau, 1.)
+
+
+def gibbs_summary_statistics(y_sample, e_sample, e_true=None):
+    """
+    scalar summaries of a single Gibbs sample, used to assess convergence of the chains
+
+    :param y_sample: sample of y_mem, the index of the item drawn for each timepoint
+    :param e_sample: sample of the event labels
+    :param e_true: (optional) np.array, the true event labels
+
+    :return: fill rate (the fraction of timepoints reconstructed from a memory item, rather than
+             from the null trace), and the agreement of e_sample with e_true.  Without e_true,
+             the rate of event changes is used instead, as it does not depend on the labeling
+             of the events
+    """
+    fill_rate = np.mean(np.asarray(y_sample) >= 0)
+    e_sample = np.asarray(e_sample)
+    if e_true is not None:
+        e_stat = np.mean(e_sample == e_true)
+    else:
+        e_stat = np.mean(e_sample[1:] != e_sample[:-1])
+    return np.array([fill_rate, e_stat])
+
+
+def _rebuild_event_models(f_class, d, f_opts, states):
+    # the event models, from their learned states (see LinearEvent.get_state), sharing a new network
+    event_models, model = dict(), None
+    for k, state in states.items():
+        e_model = f_class(d, **f_opts)
+        if model is None:
+            model = e_model.init_model()
+        else:
+            e_model.set_model(model)
+        e_model.set_state(state)
+        event_models[k] = e_model
+    return event_models
+
+
+def _gibbs_chain_worker(seed, commands, results, y_mem, event_model_args, gibbs_kwargs, e_true):
+    """ run a single chain in a worker process, until told to stop """
+    try:
+        # each chain has it's own, independent, random stream
+        np.random.seed(seed)
+
+        event_models = _rebuild_event_models(*event_model_args)
+        gibbs_kwargs = dict(event_models=event_models, **gibbs_kwargs)
+        gibbs_kwargs['trace_index'] = index_trace_by_time(y_mem)
+        y_sample, e_sample, x_sample = _init_gibbs_sample(y_mem, **gibbs_kwargs)
+
+        while True:
+            n_sweeps, keep_samples = commands.get()
+            if n_sweeps is None:
+                break
+
+            samples, stats = [], []
+            for _ in range(n_sweeps):
+                y_sample, e_sample, x_sample = _gibbs_sweep(y_mem, y_sample, e_sample, x_sample, **gibbs_kwargs)
+                if keep_samples:
+                    samples.append((y_sample, e_sample, x_sample))
+                    stats.append(gibbs_summary_statistics(y_sample, e_sample, e_true))
+            results.put((samples, stats, None))
+    except Exception:
+        results.put((None, None, traceback.format_exc()))
+
+
+def multichain_gibbs(y_mem, sem_model, memory_alpha, memory_lambda, memory_epsilon, b, tau, n_chains=4,
+                     n_burnin=25, max_samples=250, min_samples=25, check_every=25, r_hat_threshold=1.05,
+                     min_ess=100, e_true=None, seed=None, progress_bar=True, leave_progress_bar=True,
+                     e_sampler='forward'):
+    """
+    run several Gibbs chains in parallel worker processes and sample until they have converged
+
+    :param y_mem: MemoryTrace (or list of 3-tuples (x_mem, e_mem, t_mem)), corrupted memory trace
+    :param sem_mdoel: trained SEM instance
+    :param memory_alpha: SEM alpha parameter to use in reconstruction
+    :param memory_labmda: SEM lmbda parameter to use in reconstruction
+    :param memory_epsilon: (float) parameter controlling propensity to include null trace in reconstruction
+    :param b: (int) time index corruption noise
+    :param tau: (float, greater than zero) feature vector corruption noise
+    :param n_chains: (int, default 4) number of chains, each is run in its own process
+    :param n_burnin: (int, default 25) number of Gibbs sampling itterations to burn in each chain
+    :param max_samples: (int, default 250) maximum number of Gibbs samples to collect per chain
+    :param min_samples: (int, default 25) minimum number of Gibbs samples to collect per chain
+    :param check_every: (int, default 25) number of itterations between convergence checks
+    :param r_hat_threshold: (float, default 1.05) the chains have converged when R-hat is below this
+                            for all of the summary statistics...
+    :param min_ess: (float, default 100) ...and the effective sample size is at least this
+    :param e_true: (optional) true event labels, used for the segmentation summary statistic
+    :param seed: (optional) int, seed of the random streams of the chains
+    :param progress_bar: (bool) use progress bar for sampling?
+    :param leave_progress_bar: (bool, default=True) leave the progress bar at the end? 
+    :param e_sampler: (str, default 'forward') sampler of the event labels (see gibbs_memory_sampler)
+
+    :return: y_samples, e_samples, x_samples - Gibbs samples, merged across chains (see gibbs_memory_sampler)
+             diagnostics - dict with the R-hat and effective sample size of each summary
+                           statistic (nan if no samples were collected), the number of samples
+                           per chain and whether the chains converged
+
+    N.B. the worker processes are spawned (not forked) so they get their own tensorflow runtime.
+    The event models are rebuilt in each worker from their learned states, which requires
+    sem_model.f_class and sem_model.f_opts to be picklable
+    """
+
+    y_mem = as_memory_trace(y_mem)
+    gibbs_kwargs = dict(
+        memory_alpha=memory_alpha, memory_lambda=memory_lambda, memory_epsilon=memory_epsilon, b=b, tau=tau,
+        e_sampler=e_sampler,
+    )
+
+    # independent random streams for each chain
+    seeds = [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(n_chains)]
+
+    event_models = _trained_event_models(sem_model)
+    event_model_args = (
+        sem_model.f_class, sem_model.d, sem_model.f_opts, {k: e.get_state() for k, e in event_models.items()}
+    )
+
+    ctx = multiprocessing.get_context('spawn')
+    workers = []
+    for chain_seed in seeds:
+        commands, results = ctx.Queue(), ctx.Queue()
+        p = ctx.Process(
+            target=_gibbs_chain_worker,
+            args=(chain_seed, commands, results, y_mem, event_model_args, gibbs_kwargs, e_true)
+        )
+        p.start()
+        workers.append((p, commands, results))
+
+    def get_result(p, results):
+        while True:
+            try:
+                return results.get(timeout=1.)
+            except Empty:
+                if not p.is_alive() and results.empty():
+                    return None, None, 'the worker process exited unexpectedly (exit code {})'.format(p.exitcode)
+
+    def run_chains(n_sweeps, keep_samples):
+        for _, commands, _ in workers:
+            commands.put((n_sweeps, keep_samples))
+        # collect the results of every chain, even after an error, so none are left in the queues
+        output = [get_result(p, results) for p, _, results in workers]
+        for _, _, error in output:
+            if error is not None:
+                raise RuntimeError('Gibbs chain failed (in subprocess)\n%s' % error)
+        return [(samples, stats) for samples, stats, _ in output]
+
+    def stop_chains():
+        for _, commands, _ in workers:
+            commands.put((None, None))
+        for p, _, results in workers:
+            # a process can't be joined while its results are unread, drain them first
+            while p.is_alive():
+                try:
+                    results.get(timeout=0.1)
+                except Empty:
+                    pass
+            p.join()
+
+    if progress_bar:
+        pbar = tqdm(total=n_burnin + max_samples, desc='Gibbs Sampler', leave=leave_progress_bar)
+
+    chain_samples = [[] for _ in range(n_chains)]
+    chain_stats = [[] for _ in range(n_chains)]
+    statistics = ['fill_rate', 'e_agreement' if e_true is not None else 'e_change_rate']
+    r_hat, ess = np.full(len(statistics), np.nan), np.full(len(statistics), np.nan)
+    converged = False
+    try:
+        if n_burnin > 0:
+            run_chains(n_burnin, False)
+            if progress_bar:
+                pbar.update(n_burnin)
+
+        n_collected = 0
+        while n_collected < max_samples:
+            n_sweeps = min(check_every, max_samples - n_collected)
+            for ii, (samples, stats) in enumerate(run_chains(n_sweeps, True)):
+                chain_samples[ii] += samples
+                chain_stats[ii] += stats
+            n_collected += n_sweeps
+            if progress_bar:
+                pbar.update(n_sweeps)
+
+            # check convergence on each of the summary statistics
+            stats = np.array(chain_stats)  # chains x samples x statistics
+            r_hat = np.array([gelman_rubin(stats[:, :, jj]) for jj in range(stats.shape[2])])
+            ess = np.array([effective_sample_size(stats[:, :, jj]) for jj in range(stats.shape[2])])
+            converged = (n_collected >= min_samples) and np.all(r_hat < r_hat_threshold) and np.all(ess >= min_ess)
+            if converged:
+                break
+    finally:
+        stop_chains()
+        if progress_bar:
+            pbar.close()
+
+    samples = [sample for chain in chain_samples for sample in chain]
+    y_samples = np.array([y_sample for (y_sample, _, _) in samples])
+    e_samples = np.array([e_sample for (_, e_sample, _) in samples])
+    x_samples = np.array([x_sample for (_, _, x_sample) in samples])
+
+    diagnostics = dict(
+        r_hat=dict(zip(statistics, r_hat)),
+        ess=dict(zip(statistics, ess)),
+        n_samples=len(chain_samples[0]),
+        converged=converged,
+    )
+    return y_samples, e_samples, x_samples, diagnostics
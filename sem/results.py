@@ -0,0 +1,143 @@
+import os
+import glob
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+# per-scene outputs of SEM.run that are streamed to disk, and their dtypes
+RESULTS_COLUMNS = (
+    ('e_hat', np.int64),  # MAP event label
+    ('post', np.float64),  # posterior probability of the MAP event label
+    ('log_boundary_probability', np.float64),
+    ('surprise', np.float64),
+    ('pe', np.float64),  # prediction error
+    ('log_loss', np.float64),
+)
+
+# a parquet file per flushed chunk, so that every flush leaves readable files
+_parquet_file = 'results-{:06d}.parquet'
+
+
+def _parquet_files(path):
+    # the parquet files of the chunks, in order
+    return sorted(glob.glob(os.path.join(path, 'results-*.parquet')))
+
+
+class ResultsWriter(object):
+    """
+    Appends the per-scene outputs of SEM.run to columnar files on disk, a chunk at a time,
+    so that the results of long runs never need to be held in memory (see SEM.run,
+    results_sink).  Load them back with load_results.
+
+    Parameters
+    ----------
+    path: str
+        directory to write to (created if needed)
+
+    chunk_size: int (default 10000)
+        number of scenes buffered in memory before they are written out
+
+    file_format: str, 'parquet', 'binary' or None (default None)
+        'parquet': a parquet file per chunk (requires pyarrow)
+        'binary': a raw binary file per column, which can be memory-mapped
+        None: parquet if pyarrow is installed, binary otherwise
+
+    The scenes are readable with load_results as soon as they are flushed, in either format.
+    close (or leaving a with block) flushes the remaining scenes.
+
+    """
+
+    def __init__(self, path, chunk_size=10000, file_format=None):
+        if file_format is None:
+            file_format = 'parquet' if pa is not None else 'binary'
+        if file_format not in ('parquet', 'binary'):
+            raise ValueError("file_format must be 'parquet' or 'binary'")
+        if file_format == 'parquet' and pa is None:
+            raise ImportError("pyarrow is required to write parquet files")
+
+        self.path = path
+        self.chunk_size = int(chunk_size)
+        self.file_format = file_format
+        os.makedirs(path, exist_ok=True)
+
+        self._buffer = {name: np.zeros(self.chunk_size, dtype=dtype) for name, dtype in RESULTS_COLUMNS}
+        self._n_buffered = 0
+        self.n_written = 0
+        self._n_chunks = 0
+
+        # remove the files of a previous writer, in either format, so load_results never
+        # reads stale outputs
+        for filename in _parquet_files(path) + [os.path.join(path, name + '.bin') for name, _ in RESULTS_COLUMNS]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+        if file_format == 'binary':
+            # start from empty files
+            for name, _ in RESULTS_COLUMNS:
+                open(os.path.join(path, name + '.bin'), 'wb').close()
+
+    def append(self, **row):
+        """ add the outputs of a single scene, as keyword arguments named after the columns """
+        for name, _ in RESULTS_COLUMNS:
+            self._buffer[name][self._n_buffered] = row[name]
+        self._n_buffered += 1
+        if self._n_buffered == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """ write the buffered scenes to disk """
+        if self._n_buffered == 0:
+            return
+        chunk = {name: self._buffer[name][:self._n_buffered] for name, _ in RESULTS_COLUMNS}
+
+        if self.file_format == 'parquet':
+            pq.write_table(pa.table(chunk), os.path.join(self.path, _parquet_file.format(self._n_chunks)))
+        else:
+            for name, values in chunk.items():
+                with open(os.path.join(self.path, name + '.bin'), 'ab') as f:
+                    f.write(values.tobytes())
+
+        self.n_written += self._n_buffered
+        self._n_buffered = 0
+        self._n_chunks += 1
+
+    def close(self):
+        """ write the remaining scenes """
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_results(path):
+    """
+    Loads the per-scene outputs written by a ResultsWriter
+
+    :param path: directory of the ResultsWriter
+    :return: dictionary {column name: array}.  The columns of binary files are read-only
+             memory-maps, so they are not loaded into memory until they are used
+    """
+    parquet_files = _parquet_files(path)
+    if len(parquet_files) > 0:
+        if pq is None:
+            raise ImportError("pyarrow is required to read parquet files")
+        table = pa.concat_tables([pq.read_table(filename, memory_map=True) for filename in parquet_files])
+        return {name: table.column(name).to_numpy() for name, _ in RESULTS_COLUMNS}
+
+    results = dict()
+    for name, dtype in RESULTS_COLUMNS:
+        filename = os.path.join(path, name + '.bin')
+        if os.path.getsize(filename) == 0:
+            results[name] = np.zeros(0, dtype=dtype)
+        else:
+            results[name] = np.memmap(filename, dtype=dtype, mode='r')
+    return results
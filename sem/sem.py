@@ -1,12 +1,18 @@
+import os
+import shutil
+import tempfile
+import multiprocessing
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import tensorflow as tf
 from scipy.special import logsumexp
 from tqdm import tqdm
-from .event_models import GRUEvent
-from .utils import delete_object_attributes, processify
+from .event_models import GRUEvent, set_thread_model
+from .training import AsyncTrainer
+from .utils import delete_object_attributes, processify, diagonal_mvnorm_logprob
 
 # there are a ~ton~ of tf warnings from Keras, suppress them here
-import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 
@@ -15,9 +21,18 @@ class Results(object):
     pass
 
 
+def _scene_surprise(log_post_prev, log_like):
+    # Bayesian surprise of a scene: the log marginal likelihood of the scene under the
+    # (normalized) posterior over the event types at the previous scene
+    if log_post_prev is None:
+        return 0.
+    return logsumexp(log_post_prev + log_like)
+
+
 class SEM(object):
 
-    def __init__(self, lmda=1., alfa=10.0, f_class=GRUEvent, f_opts=None):
+    def __init__(self, lmda=1., alfa=10.0, f_class=GRUEvent, f_opts=None, max_live_models=None,
+                 min_live_count=None, spill_dir=None):
         """
         Parameters
         ----------
@@ -34,6 +49,22 @@ class SEM(object):
 
         f_opts: dictionary
             kwargs for initializing f_class
+
+        max_live_models: int (default None)
+            maximum number of event models kept in memory.  When there are more, the
+            least used ones (by their count in the sCRP prior) are retired: their state is
+            spilled to disk and they are no longer evaluated as candidates, until their count
+            ranks them among the top max_live_models again or they are accessed through
+            get_event_model.  The current event model is never retired, and the untrained
+            model of the new event type isn't counted.  None keeps every event model in memory
+
+        min_live_count: int (default None)
+            event models with a count of at least min_live_count are never retired, even
+            if there are more than max_live_models of them
+
+        spill_dir: str (default None)
+            directory to spill the retired event models to.  Defaults to a temporary
+            directory, deleted with clear_event_models
         """
         self.lmda = lmda
         self.alfa = alfa
@@ -53,6 +84,16 @@ class SEM(object):
         self.event_models = dict()  # event model for each event type
         self.model = None # this is the tensorflow model that gets used
 
+        # retirement of rarely used event models
+        self.max_live_models = max_live_models
+        self.min_live_count = min_live_count
+        self.spill_dir = spill_dir
+        self._spill_dir_is_temp = False
+        self.retired_models = dict()  # event type -> path of the spilled state
+
+        self._trainer = None  # background training of the event models (see run)
+        self._thread_pool = None  # scoring of the candidate event models (see run_w_boundaries)
+
         self.x_prev = None  # last scene
         self.k_prev = None  # last event type
 
@@ -61,11 +102,26 @@ class SEM(object):
         # instead of dumping the results, store them to the object
         self.results = None
 
-    def pretrain(self, x, event_types, event_boundaries, progress_bar=True, leave_progress_bar=True):
+    def pretrain(self, x, event_types, event_boundaries, progress_bar=True, leave_progress_bar=True, bulk=False,
+                 n_passes=1, n_jobs=1):
         """
         Pretrain a bunch of event models on sequence of scenes X
         with corresponding event labels y, assumed to be between 0 and K-1
         where K = total # of distinct event types
+
+        bulk: bool (default False)
+            collect the training pairs of every event type first, then train each event model
+            once on all of its pairs (see LinearEvent.estimate_all), instead of after every scene
+
+        n_passes: int (default 1)
+            number of full passes over all of the training pairs of each event type, in bulk
+            mode (see LinearEvent.estimate_all).  This is not the n_epochs of the event models,
+            which is the number of minibatches per update
+
+        n_jobs: int (default 1)
+            number of worker processes training independent event types in parallel, in bulk
+            mode.  The workers are spawned (not forked) so they get their own tensorflow
+            runtime, which requires f_class and f_opts to be picklable
         """
         assert x.shape[0] == event_types.size
 
@@ -92,33 +148,50 @@ class SEM(object):
             x_curr = x[ii, :].copy()  # current scene
             k = event_types[ii]  # current event
 
-            if k not in self.event_models.keys():
+            if k in self.retired_models:
+                self._restore_event_model(k)
+            elif k not in self.event_models.keys():
                 # initialize new event model
-                new_model = self.f_class(self.d, **self.f_opts)
-                if self.model is None:
-                    self.model = new_model.init_model()
-                else:
-                    new_model.set_model(self.model)
-                self.event_models[k] = new_model
+                self.event_models[k] = self._new_event_model()
 
-            # update event model
+            # update event model (in bulk mode, only store the training pairs)
             if not event_boundaries[ii]:
                 # we're in the same event -> update using previous scene
                 assert self.x_prev is not None
-                self.event_models[k].update(self.x_prev, x_curr, update_estimate=True)
+                self.event_models[k].update(self.x_prev, x_curr, update_estimate=not bulk)
             else:
                 # we're in a new event -> update the initialization point only
                 self.event_models[k].new_token()
-                self.event_models[k].update_f0(x_curr, update_estimate=True)
+                self.event_models[k].update_f0(x_curr, update_estimate=not bulk)
 
             self.c[k] += 1  # update counts
 
             self.x_prev = x_curr  # store the current scene for next trial
             self.k_prev = k  # store the current event for the next trial
 
+            if not bulk:
+                self.retire_event_models(keep=(k,))
+
         self.x_prev = None  # Clear this for future use
         self.k_prev = None  #
 
+        if bulk:
+            self._estimate_all(np.unique(event_types), n_passes, n_jobs)
+            self.retire_event_models()
+
+    def _estimate_all(self, event_types, n_passes=1, n_jobs=1):
+        # train each of the event models on all of their training pairs at once
+        if n_jobs == 1:
+            for k in event_types:
+                self.event_models[k].estimate_all(n_passes)
+            return
+
+        args = [(self.f_class, self.d, self.f_opts, self.event_models[k].get_state(), n_passes) for k in event_types]
+        with multiprocessing.get_context('spawn').Pool(n_jobs) as pool:
+            states = pool.map(_estimate_event_model, args)
+        for k, state in zip(event_types, states):
+            self.event_models[k].set_state(state)
+
     def _update_state(self, x, k=None):
         """
         Update internal state based on input data X and max # of event types (clusters) K
@@ -157,7 +230,117 @@ class SEM(object):
         # prior /= np.sum(prior)
         return prior
 
-    def run(self, x, k=None, progress_bar=True, leave_progress_bar=True, minimize_memory=False, compile_model=True):
+    def _new_event_model(self):
+        new_model = self.f_class(self.d, **self.f_opts)
+        if self.model is None:
+            self.model = new_model.init_model()
+        else:
+            new_model.set_model(self.model)
+        return new_model
+
+    def _close_trainer(self):
+        if self._trainer is not None:
+            trainer, self._trainer = self._trainer, None
+            trainer.close()
+
+    def _open_thread_pool(self, n_threads):
+        # each thread scores the event models with its own copy of the network
+        models = Queue()
+        for _ in range(n_threads):
+            models.put(self.f_class(self.d, **self.f_opts).init_model())
+        self._thread_pool = ThreadPoolExecutor(n_threads, initializer=_init_scoring_thread, initargs=(models,))
+
+    def _close_thread_pool(self):
+        if self._thread_pool is not None:
+            thread_pool, self._thread_pool = self._thread_pool, None
+            thread_pool.shutdown(wait=True)
+
+    def _map_candidates(self, func, candidates):
+        # [func(k0) for k0 in candidates], in the thread pool if there is one.  The results are
+        # in the order of the candidates, so the MAP event type does not depend on the threads
+        if self._thread_pool is None:
+            return [func(k0) for k0 in candidates]
+        return list(self._thread_pool.map(func, candidates))
+
+    def _retire_event_model(self, k):
+        # spill the state of the event model to disk and drop it from memory
+        if self._trainer is not None:
+            # wait for the pending updates, which may include this event model
+            self._trainer.join()
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='sem_')
+            self._spill_dir_is_temp = True
+        path = os.path.join(self.spill_dir, 'event_model_{}.npz'.format(k))
+        np.savez_compressed(path, **self.event_models[k].get_state())
+        self.event_models.pop(k).clear()
+        self.retired_models[k] = path
+
+    def _restore_event_model(self, k):
+        new_model = self._new_event_model()
+        path = self.retired_models.pop(k)
+        with np.load(path) as state:
+            new_model.set_state(dict(state))
+        os.remove(path)
+        self.event_models[k] = new_model
+
+    def retire_event_models(self, keep=()):
+        """
+        Retire the least used event models (lowest count in the sCRP prior) until no more
+        than max_live_models are in memory.  Models in keep, and models with a count of at
+        least min_live_count, are never retired
+        """
+        # the untrained event model of the new event type (count of 0) is neither counted nor retired
+        live = [k0 for k0 in self.event_models.keys() if self.c[k0] > 0]
+        if self.max_live_models is None or len(live) <= self.max_live_models:
+            return
+        candidates = [
+            k0 for k0 in live
+            if (k0 not in keep) and (self.min_live_count is None or self.c[k0] < self.min_live_count)
+        ]
+        n_retire = len(live) - self.max_live_models
+        for k0 in sorted(candidates, key=lambda k0: self.c[k0])[:n_retire]:
+            self._retire_event_model(k0)
+
+    def get_event_model(self, k):
+        """ returns the event model of event type k, reloading it from disk if it was retired """
+        if k in self.retired_models:
+            self._restore_event_model(k)
+        return self.event_models[k]
+
+    def restore_event_models(self):
+        """ reload all of the retired event models into memory """
+        for k in list(self.retired_models.keys()):
+            self._restore_event_model(k)
+
+    def _restore_selected_event_models(self, active):
+        # retired event models are reloaded when their count ranks them among the event models
+        # that retire_event_models keeps, i.e. above the weakest live model other than the
+        # current one (ties go to the live models).  Ranking by the same criterion as the
+        # retirement keeps a reloaded model from being retired again.  Returns the reloaded
+        # event types, which should also be kept at the next retirement
+        if len(self.retired_models) == 0:
+            return []
+        if self.max_live_models is None:
+            # no limit (any more), so nothing is retired: reload all of them
+            restored = list(self.retired_models.keys())
+            self.restore_event_models()
+            return restored
+        live = [k0 for k0 in self.event_models.keys() if self.c[k0] > 0 and k0 != self.k_prev]
+        n_kept = self.max_live_models - int(self.k_prev in self.event_models)
+        live_counts = np.sort(self.c[live])[::-1]
+        if n_kept <= 0:
+            threshold = np.inf
+        elif live_counts.size >= n_kept:
+            threshold = live_counts[n_kept - 1]
+        else:
+            threshold = -np.inf
+        restored = [k0 for k0 in active if (k0 in self.retired_models) and (self.c[k0] > threshold)]
+        for k0 in restored:
+            self._restore_event_model(k0)
+        return restored
+
+    def run(self, x, k=None, progress_bar=True, leave_progress_bar=True, minimize_memory=False, compile_model=True,
+            async_training=False, max_staleness=1, max_queue_size=32, results_sink=None, store_diagnostics=None):
         """
         Parameters
         ----------
@@ -178,10 +361,38 @@ class SEM(object):
         compile_model: bool (default = True)
             compile the stored model.  Leave false if previously run.
 
+        async_training: bool (default = False)
+            train the event models on a background thread (see training.AsyncTrainer).  The
+            likelihoods of each scene are then evaluated with the last published weights,
+            which can lag behind by up to max_staleness updates.  All of the updates are
+            trained on before run returns
+
+        max_staleness: int or None (default = 1)
+            maximum number of pending updates when evaluating a scene, with async_training
+
+        max_queue_size: int (default = 32)
+            maximum number of queued updates, with async_training
+
+        results_sink: results.ResultsWriter (default = None)
+            if given, the per-scene outputs (e_hat, MAP posterior, boundary probability,
+            surprise, prediction error and log loss) are appended to it during the run, and
+            only the outputs of the current scene are held in memory: the per-scene results
+            (post, pe, x_hat, surprise, e_hat, log_loss and log_boundary_probability) are None
+            (load them with results.load_results).  run flushes the sink at the end, so the
+            outputs can be loaded as soon as it returns.  The sink is not closed, so that
+            further runs can append to it: close it (or use it in a with block) when done
+
+        store_diagnostics: bool (default = None)
+            store the n by k log likelihood and log prior of every scene (results.log_like and
+            results.log_prior).  The other results are computed one scene at a time and don't
+            need them, so turning this off saves two n by k arrays.  None stores them unless
+            there is a results_sink
+
 
         Return
         ------
-        post: n by k array of posterior probabilities
+        post: n by k array of posterior probabilities.  With a results_sink, run returns None
+            and the per-scene results are None
 
         """
 
@@ -194,11 +405,14 @@ class SEM(object):
 
         # initialize arrays
         print("# initialize arrays")
+        # with a results sink, only the row of the current scene is kept (row 0), otherwise
+        # row ii holds scene ii
+        n_rows = n if results_sink is None else 1
         # if not minimize_memory:
-        post = np.zeros((n, self.k))
-        pe = np.zeros(np.shape(x)[0])
-        x_hat = np.zeros(np.shape(x))
-        log_boundary_probability = np.zeros(np.shape(x)[0])
+        post = np.zeros((n_rows, self.k))
+        pe = np.zeros(n_rows)
+        x_hat = np.zeros((n_rows, self.d))
+        log_boundary_probability = np.zeros(n_rows)
         
         print("# these are special case variables to deal with the possibility the current event is restarted")
         # these are special case variables to deal with the possibility the current event is restarted
@@ -206,9 +420,21 @@ class SEM(object):
         repeat_prob = -np.inf
         restart_prob = 0
 
-        #
-        log_like = np.zeros((n, self.k)) - np.inf
-        log_prior = np.zeros((n, self.k)) - np.inf
+        # per-scene outputs, computed from the log likelihood and log prior of the current and
+        # previous scene only
+        surprise = np.zeros(n_rows)
+        e_hat = np.zeros(n_rows, dtype=int)
+        log_loss = np.zeros(n_rows)
+        log_post_prev = None  # normalized log posterior of the previous scene
+
+        # diagnostic readouts, these do not effect the model
+        if store_diagnostics is None:
+            store_diagnostics = results_sink is None
+        if store_diagnostics:
+            log_like = np.zeros((n, self.k)) - np.inf
+            log_prior = np.zeros((n, self.k)) - np.inf
+        else:
+            log_like, log_prior = None, None
         print("# this code just controls the presence/absence of a progress bar -- it isn't important")
         # this code just controls the presence/absence of a progress bar -- it isn't important
         if progress_bar:
@@ -218,119 +444,164 @@ class SEM(object):
             def my_it(l):
                 return range(l)
 
+        if async_training:
+            # the training thread gets its own copy of the network
+            self._trainer = AsyncTrainer(self.f_class(self.d, **self.f_opts).init_model(),
+                                         max_staleness=max_staleness, max_queue_size=max_queue_size)
 
-        for ii in my_it(n):
+        try:
+            for ii in my_it(n):
 
-            x_curr = x[ii, :].copy()
+                x_curr = x[ii, :].copy()
+                row = ii if results_sink is None else 0
+                if results_sink is not None:
+                    post[row, :] = 0.
 
-            # calculate sCRP prior
-            prior = self._calculate_unnormed_sCRP(self.k_prev)
-            # N.B. k_prev should be none for the first event if there wasn't pre-training
+                if self._trainer is not None:
+                    # don't let the published weights get more than max_staleness updates behind
+                    self._trainer.wait()
 
-            # likelihood
-            active = np.nonzero(prior)[0]
-            lik = np.zeros(len(active))
+                # calculate sCRP prior
+                prior = self._calculate_unnormed_sCRP(self.k_prev)
+                # N.B. k_prev should be none for the first event if there wasn't pre-training
 
-            for k0 in active:
-                if k0 not in self.event_models.keys():
-                    new_model = self.f_class(self.d, **self.f_opts)
-                    if self.model is None:
-                        self.model = new_model.init_model()
-                    else:
-                        new_model.set_model(self.model)
-                    self.event_models[k0] = new_model
-                    new_model = None  # clear the new model variable (but not the model itself) from memory
+                # likelihood
+                active = np.nonzero(prior)[0]
+                lik = np.zeros(len(active))
+                restored = self._restore_selected_event_models(active)
 
-                # get the log likelihood for each event model
-                model = self.event_models[k0]
+                for k0 in active:
+                    if k0 in self.retired_models:
+                        # retired event models are not candidates
+                        lik[k0] = -np.inf
+                        continue
 
-                # detect when there is a change in event types (not the same thing as boundaries)
-                current_event = (k0 == self.k_prev)
+                    if k0 not in self.event_models.keys():
+                        self.event_models[k0] = self._new_event_model()
 
-                if current_event:
-                    assert self.x_prev is not None
-                    lik[k0] = model.log_likelihood_next(self.x_prev, x_curr)
+                    # get the log likelihood for each event model
+                    model = self.event_models[k0]
 
-                    # special case for the possibility of returning to the start of the current event
-                    lik_restart_event = model.log_likelihood_f0(x_curr)
+                    # detect when there is a change in event types (not the same thing as boundaries)
+                    current_event = (k0 == self.k_prev)
 
-                else:
-                    lik[k0] = model.log_likelihood_f0(x_curr)
+                    if current_event:
+                        assert self.x_prev is not None
+                        lik[k0] = model.log_likelihood_next(self.x_prev, x_curr)
 
-            # determine the event identity (without worrying about event breaks for now)
-            _post = np.log(prior[:len(active)]) + lik
-            if ii > 0:
-                # the probability that the current event is repeated is the OR probability -- but b/c
-                # we are using a MAP approximation over all possibilities, it is a max of the repeated/restarted
+                        # special case for the possibility of returning to the start of the current event
+                        lik_restart_event = model.log_likelihood_f0(x_curr)
 
-                # is restart higher under the current event
-                restart_prob = lik_restart_event + np.log(prior[self.k_prev] - self.lmda)
-                repeat_prob = _post[self.k_prev]
-                _post[self.k_prev] = np.max([repeat_prob, restart_prob])
+                    else:
+                        lik[k0] = model.log_likelihood_f0(x_curr)
 
-            # get the MAP cluster and only update it
-            k = np.argmax(_post)  # MAP cluster
+                # determine the event identity (without worrying about event breaks for now)
+                _post = np.log(prior[:len(active)]) + lik
+                if ii > 0:
+                    # the probability that the current event is repeated is the OR probability -- but b/c
+                    # we are using a MAP approximation over all possibilities, it is a max of the repeated/restarted
 
-            # determine whether there was a boundary
-            event_boundary = (k != self.k_prev) or ((k == self.k_prev) and (restart_prob > repeat_prob))
+                    # is restart higher under the current event
+                    restart_prob = lik_restart_event + np.log(prior[self.k_prev] - self.lmda)
+                    repeat_prob = _post[self.k_prev]
+                    _post[self.k_prev] = np.max([repeat_prob, restart_prob])
 
-            # calculate the event boundary probability
-            _post[self.k_prev] = restart_prob
-            # if not minimize_memory:
-            log_boundary_probability[ii] = logsumexp(_post) - logsumexp(np.concatenate([_post, [repeat_prob]]))
+                # get the MAP cluster and only update it
+                k = np.argmax(_post)  # MAP cluster
 
-            # calculate the probability of an event label, ignoring the event boundaries
-            if self.k_prev is not None:
-                _post[self.k_prev] = logsumexp([restart_prob, repeat_prob])
-                prior[self.k_prev] -= self.lmda / 2.
-                lik[self.k_prev] = logsumexp(np.array([lik[self.k_prev], lik_restart_event]))
+                # determine whether there was a boundary
+                event_boundary = (k != self.k_prev) or ((k == self.k_prev) and (restart_prob > repeat_prob))
 
-                # now, the normalized posterior
+                # calculate the event boundary probability
+                _post[self.k_prev] = restart_prob
                 # if not minimize_memory:
-                p = np.log(prior[:len(active)]) + lik
-                post[ii, :len(active)] = np.exp(p - logsumexp(p))
+                log_boundary_probability[row] = logsumexp(_post) - logsumexp(np.concatenate([_post, [repeat_prob]]))
 
-                # this is a diagnostic readout and does not effect the model
-                log_like[ii, :len(active)] = lik
-                log_prior[ii, :len(active)] = np.log(prior[:len(active)])
+                # calculate the probability of an event label, ignoring the event boundaries
+                if self.k_prev is not None:
+                    _post[self.k_prev] = logsumexp([restart_prob, repeat_prob])
+                    prior[self.k_prev] -= self.lmda / 2.
+                    lik[self.k_prev] = logsumexp(np.array([lik[self.k_prev], lik_restart_event]))
 
-                # These aren't used again, remove from memory
-                _post = None
-                lik = None
-                prior = None
+                    # now, the normalized posterior
+                    # if not minimize_memory:
+                    p = np.log(prior[:len(active)]) + lik
+                    post[row, :len(active)] = np.exp(p - logsumexp(p))
 
-            else:
-                log_like[ii, 0] = 0.0
-                log_prior[ii, 0] = self.alfa
-                # if not minimize_memory:
-                post[ii, 0] = 1.0
+                    log_like_ii = np.zeros(self.k) - np.inf
+                    log_prior_ii = np.zeros(self.k) - np.inf
+                    log_like_ii[:len(active)] = lik
+                    log_prior_ii[:len(active)] = np.log(prior[:len(active)])
 
-            if not minimize_memory:
-                # prediction error: euclidean distance of the last model and the current scene vector
-                if ii > 0:
-                    model = self.event_models[self.k_prev]
-                    x_hat[ii, :] = model.predict_next(self.x_prev)
-                    pe[ii] = np.linalg.norm(x_curr - x_hat[ii, :])
-                    # surprise[ii] = log_like[ii, self.k_prev]
+                    # These aren't used again, remove from memory
+                    _post = None
+                    lik = None
+                    prior = None
 
-            self.c[k] += 1  # update counts
-            # update event model
-            if not event_boundary:
-                # we're in the same event -> update using previous scene
-                assert self.x_prev is not None
-                self.event_models[k].update(self.x_prev, x_curr)
-            else:
-                # we're in a new event token -> update the initialization point only
-                self.event_models[k].new_token()
-                self.event_models[k].update_f0(x_curr)
+                else:
+                    log_like_ii = np.zeros(self.k) - np.inf
+                    log_prior_ii = np.zeros(self.k) - np.inf
+                    log_like_ii[0] = 0.0
+                    log_prior_ii[0] = self.alfa
+                    # if not minimize_memory:
+                    post[row, 0] = 1.0
+
+                if not minimize_memory:
+                    # prediction error: euclidean distance of the last model and the current scene vector
+                    if ii > 0:
+                        model = self.event_models[self.k_prev]
+                        x_hat[row, :] = model.predict_next(self.x_prev)
+                        pe[row] = np.linalg.norm(x_curr - x_hat[row, :])
+                        # surprise[ii] = log_like[ii, self.k_prev]
+
+                # Bayesian surprise, MAP label and log loss of the scene
+                log_post_ii = log_like_ii + log_prior_ii
+                surprise[row] = _scene_surprise(log_post_prev, log_like_ii)
+                e_hat[row] = np.argmax(log_post_ii)
+                log_loss[row] = logsumexp(log_post_ii)
+                log_post_prev = log_post_ii - log_loss[row]
+
+                if store_diagnostics:
+                    log_like[ii, :] = log_like_ii
+                    log_prior[ii, :] = log_prior_ii
+
+                if results_sink is not None:
+                    results_sink.append(
+                        e_hat=e_hat[row], post=np.max(post[row, :]),
+                        log_boundary_probability=log_boundary_probability[row], surprise=surprise[row], pe=pe[row],
+                        log_loss=log_loss[row],
+                    )
+
+                self.c[k] += 1  # update counts
+                # update event model
+                if not event_boundary:
+                    # we're in the same event -> update using previous scene
+                    assert self.x_prev is not None
+                    if self._trainer is not None:
+                        self._trainer.update(self.event_models[k], self.x_prev, x_curr)
+                    else:
+                        self.event_models[k].update(self.x_prev, x_curr)
+                else:
+                    # we're in a new event token -> update the initialization point only
+                    if self._trainer is not None:
+                        self._trainer.new_token(self.event_models[k], x_curr)
+                    else:
+                        self.event_models[k].new_token()
+                        self.event_models[k].update_f0(x_curr)
 
-            self.x_prev = x_curr  # store the current scene for next trial
-            self.k_prev = k  # store the current event for the next trial
+                self.x_prev = x_curr  # store the current scene for next trial
+                self.k_prev = k  # store the current event for the next trial
+
+                self.retire_event_models(keep=(k,) + tuple(restored))
+        finally:
+            # barrier: train on all of the pending updates (and stop the training thread, also
+            # after an error)
+            self._close_trainer()
 
-        # calculate Bayesian Surprise
-        log_post = log_like[:-1, :] + log_prior[:-1, :]
-        log_post -= np.tile(logsumexp(log_post, axis=1), (np.shape(log_post)[1], 1)).T
-        surprise = np.concatenate([[0], logsumexp(log_post + log_like[1:, :], axis=1)])
+        if results_sink is not None:
+            # the per-scene outputs are in the sink
+            results_sink.flush()
+            post, pe, surprise, e_hat, x_hat, log_loss, log_boundary_probability = [None] * 7
 
         self.results = Results()
         self.results.post = post
@@ -338,9 +609,9 @@ class SEM(object):
         self.results.surprise = surprise
         self.results.log_like = log_like
         self.results.log_prior = log_prior
-        self.results.e_hat = np.argmax(log_like + log_prior, axis=1)
+        self.results.e_hat = e_hat
         self.results.x_hat = x_hat
-        self.results.log_loss = logsumexp(log_like + log_prior, axis=1)
+        self.results.log_loss = log_loss
         self.results.log_boundary_probability = log_boundary_probability
 
         if minimize_memory:
@@ -423,6 +694,24 @@ class SEM(object):
         # likelihood
         active = np.nonzero(prior)[0]
         lik = np.zeros((n_scene, len(active)))
+        restored = self._restore_selected_event_models(active)
+        candidates = [k0 for k0 in active if k0 not in self.retired_models]
+        # retired event models are not candidates
+        lik[:, [k0 for k0 in active if k0 in self.retired_models]] = -np.inf
+
+        # verify a model has been initialized for each potentially active event model
+        for k0 in candidates:
+            if k0 not in self.event_models.keys():
+                self.event_models[k0] = self._new_event_model()
+
+        # the log likelihood of every scene under each event model.  None of the event models
+        # can be updated until *after* the event has been observed, so the event models are
+        # independent of each other and can be scored concurrently (see n_threads)
+        scene_log_likelihoods = self._map_candidates(
+            lambda k0: _event_log_likelihood(self.event_models[k0], x), candidates
+        )
+        for k0, scene_lik in zip(candidates, scene_log_likelihoods):
+            lik[:, k0] = scene_lik
 
         # again, this is a readout of the model only and not used for updating,
         # but also keep track of the within event posterior
@@ -430,62 +719,19 @@ class SEM(object):
             _x_hat = np.zeros((n_scene, self.d))  # temporary storre
             _sigma = np.zeros((n_scene, self.d))
 
+            for ii in range(n_scene):
 
-        for ii, x_curr in enumerate(x):
-
-            # we need to maintain a distribution over possible event types for the current events --
-            # this gets locked down after termination of the event.
-            # Also: none of the event models can be updated until *after* the event has been observed
-
-            # special case the first scene within the event
-            if ii == 0:
-                event_boundary = True
-            else:
-                event_boundary = False
-
-            # loop through each potentially active event model and verify 
-            # a model has been initialized
-            for k0 in active:
-                if k0 not in self.event_models.keys():
-                    new_model = self.f_class(self.d, **self.f_opts)
-                    if self.model is None:
-                        self.model = new_model.init_model()
-                    else:
-                        new_model.set_model(self.model)
-                    self.event_models[k0] = new_model
-
-            ### ~~~~~ Start ~~~~~~~###
-
-            ## prior to updating, pull x_hat based on the ongoing estimate of the event label
-            if ii == 0:
-                # prior to the first scene within an event having been observed
-                k_within_event = np.argmax(prior)  
-            else:
-                # otherwise, use previously observed scenes
-                k_within_event = np.argmax(np.sum(lik[:ii, :len(active)], axis=0) + np.log(prior[:len(active)]))
-            
-            if save_x_hat:
-                if event_boundary:
+                ## pull x_hat based on the ongoing estimate of the event label
+                if ii == 0:
+                    # prior to the first scene within an event having been observed
+                    k_within_event = np.argmax(prior)
                     _x_hat[ii, :] = self.event_models[k_within_event].predict_f0()
                 else:
+                    # otherwise, use previously observed scenes
+                    k_within_event = np.argmax(np.sum(lik[:ii, :len(active)], axis=0) + np.log(prior[:len(active)]))
                     _x_hat[ii, :] = self.event_models[k_within_event].predict_next_generative(x[:ii, :])
                 _sigma[ii, :] = self.event_models[k_within_event].get_variance()
 
-
-            ## Update the model, inference first!
-            for k0 in active:
-                # get the log likelihood for each event model
-                model = self.event_models[k0]
-
-                if not event_boundary:
-                    # this is correct.  log_likelihood sequence makes the model prediction internally
-                    # using predict_next_generative, and evaluates the likelihood of the prediction
-                    lik[ii, k0] = model.log_likelihood_sequence(x[:ii, :].reshape(-1, self.d), x_curr)
-                else:
-                    lik[ii, k0] = model.log_likelihood_f0(x_curr)
-            
-
-
         # cache the diagnostic measures
         log_like[-1, :len(active)] = np.sum(lik, axis=0)
 
@@ -520,6 +766,8 @@ class SEM(object):
             self.results.e_hat = np.argmax(post, axis=1)
             self.results.log_loss = logsumexp(log_like + log_prior, axis=1)
 
+            self.retire_event_models(keep=(k,) + tuple(restored))
+
             if save_x_hat:
                 x_hat[-n_scene:, :] = _x_hat
                 sigma[-n_scene:, :] = _sigma
@@ -547,7 +795,7 @@ class SEM(object):
             self.event_models[0] = new_model
 
     def run_w_boundaries(self, list_events, progress_bar=True, leave_progress_bar=True, save_x_hat=False, 
-                         generative_predicitons=False, minimize_memory=False):
+                         generative_predicitons=False, minimize_memory=False, n_threads=1):
         """
         This method is the same as the above except the event boundaries are pre-specified by the experimenter
         as a list of event tokens (the event/schema type is still inferred).
@@ -572,6 +820,11 @@ class SEM(object):
         save_x_hat: bool
             save the MAP scene predictions?
 
+        n_threads: int (default 1)
+            number of threads scoring the candidate event models of each event concurrently,
+            each with its own copy of the network.  TensorFlow releases the GIL while it
+            runs, so the candidates' predictions overlap
+
         Return
         ------
         post: n_e by k array of posterior probabilities
@@ -588,17 +841,243 @@ class SEM(object):
 
         self.init_for_boundaries(list_events)
 
-        for x in my_it(list_events):
-            self.update_single_event(x, save_x_hat=save_x_hat)
+        if n_threads > 1:
+            self._open_thread_pool(n_threads)
+        try:
+            for x in my_it(list_events):
+                self.update_single_event(x, save_x_hat=save_x_hat)
+        finally:
+            self._close_thread_pool()
         if minimize_memory:
             self.clear_event_models()
 
+    def _checkpoint(self):
+        # picklable snapshot of the state of SEM that run starts from: the counts of the sCRP
+        # prior, the last scene and event type, and the learned state of every event model
+        states = {k0: e.get_state() for k0, e in self.event_models.items()}
+        for k0, path in self.retired_models.items():
+            with np.load(path) as state:
+                states[k0] = dict(state)
+        return dict(d=self.d, c=self.c.copy(), x_prev=self.x_prev, k_prev=self.k_prev, states=states)
+
+    def _load_checkpoint(self, checkpoint, warm_start=True):
+        # inverse of _checkpoint, on a new SEM.  Without warm_start, the first scene starts a
+        # new event (as after pretraining)
+        self.d = checkpoint['d']
+        self.c = checkpoint['c'].copy()
+        self.k = self.c.size
+        if warm_start:
+            self.x_prev, self.k_prev = checkpoint['x_prev'], checkpoint['k_prev']
+        for k0, state in checkpoint['states'].items():
+            self.event_models[k0] = self._new_event_model()
+            self.event_models[k0].set_state(state)
+
+    def run_chunked(self, x, chunk_size, overlap=None, n_jobs=1, match_threshold=0., compare_sequential=False,
+                    progress_bar=True, leave_progress_bar=True):
+        """
+        Approximate, parallel version of run for very long sequences.  The sequence is split into
+        chunks of chunk_size scenes, and each chunk is segmented independently (in a worker
+        process) starting from the current state of SEM, e.g. after pretraining.  Each chunk
+        but the first also re-segments the last overlap scenes of the previous chunk, to warm
+        up and to reconcile the event types across chunks:
+
+            - the event types visited before the call are shared by all of the chunks
+            - a new event type of a chunk that is inferred in the overlap is matched to the
+              event type it co-occurs with most in the overlap, in the previous chunk
+            - otherwise, it is matched to the new event type of a previous chunk whose event
+              model gives its scenes the highest likelihood, if that is higher than their
+              likelihood under a new event model by more than match_threshold (per scene),
+              or else it becomes a new event type
+
+        The outputs are stored in self.results, as with run (without the diagnostics, see
+        store_diagnostics).  The posterior over the new event types that are never the MAP
+        label of their chunk is dropped.  The state of SEM is updated with the counts of the
+        event types and the last event model of each event type.
+
+        The chunks learn their new event types independently, so the approximation is best
+        from a warm start, when most of the event types are known (e.g. pretrain, or run on
+        the start of the sequence).
+
+        Parameters
+        ----------
+        x: N x D array of scenes
+
+        chunk_size: int
+            number of scenes per chunk
+
+        overlap: int (default max(chunk_size // 4, 1))
+            number of scenes of the previous chunk re-segmented at the start of each chunk,
+            at least 1
+
+        n_jobs: int (default 1)
+            number of worker processes.  The workers are spawned (not forked) so they get
+            their own tensorflow runtime, which requires f_class and f_opts to be picklable
+
+        match_threshold: float (default 0.)
+            minimum mean log likelihood ratio of the scenes of an event type, between the
+            event model of a previous chunk and a new event model, to match the event types
+
+        compare_sequential: bool (default False)
+            also run the sequential segmentation (run) from the same starting state, as an
+            extra job, and store the agreement of the two in results.agreement (see
+            segmentation_agreement).  The state of SEM is not affected by the sequential run
+
+        progress_bar: bool
+            use a tqdm progress bar (over the chunks)?
+
+        leave_progress_bar: bool
+            leave the progress bar after completing?
+
+        Return
+        ------
+        post: n by k array of posterior probabilities, over the k event types visited so far
+
+        """
+        n = np.shape(x)[0]
+        if overlap is None:
+            overlap = max(chunk_size // 4, 1)
+        # the first scene of a cold-started chunk only has the placeholder label of run,
+        # so it has to be in the overlap
+        if not 1 <= overlap < chunk_size:
+            raise ValueError('overlap must be at least 1 and smaller than chunk_size')
+
+        if self.d is None:
+            self.d = np.shape(x)[1]
+        checkpoint = self._checkpoint()
+        sem_kwargs = dict(lmda=self.lmda, alfa=self.alfa, f_class=self.f_class, f_opts=self.f_opts,
+                          max_live_models=self.max_live_models, min_live_count=self.min_live_count)
+
+        # each chunk starts overlap scenes before the scenes it labels
+        starts = np.arange(0, n, chunk_size)
+        args = [(sem_kwargs, checkpoint, x[max(s - overlap, 0):s + chunk_size], s > 0) for s in starts]
+        if compare_sequential:
+            args.append((sem_kwargs, checkpoint, x, False))
+
+        if progress_bar:
+            def my_it(iterator):
+                return tqdm(iterator, desc='Run SEM (chunks)', total=len(args), leave=leave_progress_bar)
+        else:
+            def my_it(iterator):
+                return iterator
+
+        if n_jobs == 1:
+            chunks = [_run_chunk(a) for a in my_it(args)]
+        else:
+            with multiprocessing.get_context('spawn').Pool(n_jobs) as pool:
+                chunks = list(my_it(pool.imap(_run_chunk, args)))
+        sequential = chunks.pop() if compare_sequential else None
+
+        # reconcile the event types of the chunks, in order.  Only the visited event types are
+        # shared, the untrained event model of the new cluster is a new event type of every chunk
+        shared = set(k0 for k0 in checkpoint['states'].keys() if checkpoint['c'][k0] > 0)
+        n_shared = max(shared) + 1 if shared else 0
+        n_types = n_shared
+        e_hat = np.zeros(n, dtype=int)
+        states = dict()  # event type -> learned state of its latest event model
+        label_maps = []
+        for s, chunk in zip(starts, chunks):
+            offset = min(s, overlap)
+            label_map = {k0: k0 for k0 in shared}
+            new_types = [k0 for k0 in states.keys() if k0 not in shared]
+            matched = []
+            for k0 in _first_appearance(chunk['e_hat']):
+                if k0 in label_map:
+                    continue
+                in_overlap = chunk['e_hat'][:offset] == k0
+                if np.any(in_overlap):
+                    label_map[k0] = _mode(e_hat[s - offset:s][in_overlap])
+                    continue
+                segments = _label_segments(x[s - offset:s + chunk_size], chunk['e_hat'], k0)
+                label_map[k0] = self._match_event_type(
+                    segments, [k1 for k1 in new_types if k1 not in matched], states, match_threshold
+                )
+                if label_map[k0] is None:
+                    label_map[k0] = n_types
+                    n_types += 1
+                matched.append(label_map[k0])
+
+            e_hat[s:s + chunk_size] = [label_map[k0] for k0 in chunk['e_hat'][offset:]]
+            for k0, state in chunk['states'].items():
+                states[label_map[k0]] = state
+            label_maps.append(label_map)
+
+        # the new event types take the next labels, each is the MAP label of at least one scene
+        if not np.all(np.isin(np.arange(n_shared, n_types), e_hat)):
+            raise RuntimeError('the new event types of the chunks were not reconciled to contiguous labels')
+
+        # stitch together the per-scene outputs
+        post = np.zeros((n, n_types))
+        for s, chunk, label_map in zip(starts, chunks, label_maps):
+            offset = min(s, overlap)
+            for k0, k1 in label_map.items():
+                if k0 < np.shape(chunk['post'])[1]:
+                    post[s:s + chunk_size, k1] += chunk['post'][offset:, k0]
+
+        self.results = Results()
+        self.results.post = post
+        self.results.e_hat = e_hat
+        for name in ('pe', 'surprise', 'log_loss', 'log_boundary_probability', 'x_hat'):
+            setattr(self.results, name, np.concatenate([
+                chunk[name][min(s, overlap):] for s, chunk in zip(starts, chunks)
+            ], axis=0))
+        self.results.log_like = None
+        self.results.log_prior = None
+        if sequential is not None:
+            self.results.agreement = segmentation_agreement(
+                sequential['e_hat'], e_hat, sequential['log_boundary_probability'],
+                self.results.log_boundary_probability,
+            )
+
+        # carry over the counts and the latest event models
+        self._update_state(x, n_types)
+        self.c += np.bincount(e_hat, minlength=self.c.size)
+        for k0, state in states.items():
+            if k0 in self.retired_models:
+                os.remove(self.retired_models.pop(k0))
+            self.event_models[k0] = self._new_event_model()
+            self.event_models[k0].set_state(state)
+        self.x_prev = x[-1, :].copy()
+        self.k_prev = e_hat[-1]
+        self.retire_event_models(keep=(self.k_prev,))
+
+        return post
+
+    def _match_event_type(self, segments, candidates, states, match_threshold):
+        # the candidate event type whose event model gives the scenes in segments the highest
+        # likelihood, if it is higher than under a new event model (None otherwise)
+        if len(candidates) == 0:
+            return None
+        new_model = self._new_event_model()
+        baseline = np.mean(np.concatenate([_segment_log_likelihood(new_model, X) for X in segments]))
+        new_model.clear()
+
+        log_likelihoods = []
+        for k0 in candidates:
+            e_model = self._new_event_model()
+            e_model.set_state(states[k0])
+            log_likelihoods.append(np.mean(np.concatenate([_segment_log_likelihood(e_model, X) for X in segments])))
+            e_model.clear()
+        best = int(np.argmax(log_likelihoods))
+        if log_likelihoods[best] - baseline > match_threshold:
+            return candidates[best]
+        return None
+
     def clear_event_models(self):
         if self.event_models is not None:
             for _, e in self.event_models.items():
                 e.clear()
                 e.model = None
-            
+
+        # the spilled states of the retired event models
+        for path in self.retired_models.values():
+            if os.path.exists(path):
+                os.remove(path)
+        self.retired_models = dict()
+        if self._spill_dir_is_temp:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+            self._spill_dir_is_temp = False
+
         self.event_models = None
         self.model = None
         tf.compat.v1.reset_default_graph()  # for being sure
@@ -612,6 +1091,116 @@ class SEM(object):
 
 
 
+def _estimate_event_model(args):
+    # worker for SEM._estimate_all: rebuild the event model in the worker, train it on all
+    # of its training pairs and return its state
+    f_class, d, f_opts, state, n_passes = args
+    e_model = f_class(d, **f_opts)
+    e_model.init_model()
+    e_model.set_state(state)
+    e_model.estimate_all(n_passes)
+    return e_model.get_state()
+
+
+def _run_chunk(args):
+    # worker for SEM.run_chunked: segment a chunk of scenes, starting from the checkpoint, and
+    # return the per-scene outputs and the learned state of the event models it inferred
+    sem_kwargs, checkpoint, x, cold_start = args
+    sem_model = SEM(**sem_kwargs)
+    sem_model._load_checkpoint(checkpoint, warm_start=not cold_start)
+    sem_model.run(x, progress_bar=False, store_diagnostics=False)
+    r = sem_model.results
+    outputs = dict(e_hat=r.e_hat, post=r.post, pe=r.pe, surprise=r.surprise, log_loss=r.log_loss,
+                   log_boundary_probability=r.log_boundary_probability, x_hat=r.x_hat)
+    outputs['states'] = {k0: sem_model.get_event_model(k0).get_state() for k0 in np.unique(r.e_hat)}
+    if sem_model._spill_dir_is_temp:
+        shutil.rmtree(sem_model.spill_dir, ignore_errors=True)
+    return outputs
+
+
+def _init_scoring_thread(models):
+    set_thread_model(models.get())
+
+
+def _event_log_likelihood(e_model, x):
+    # log likelihood of each scene of an event under an event model: the first scene given
+    # the initial point, the others given all of the preceding scenes of the event
+    lik = np.zeros(np.shape(x)[0])
+    lik[0] = e_model.log_likelihood_f0(x[0])
+    for ii in range(1, np.shape(x)[0]):
+        # this is correct.  log_likelihood sequence makes the model prediction internally
+        # using predict_next_generative, and evaluates the likelihood of the prediction
+        lik[ii] = e_model.log_likelihood_sequence(x[:ii, :].reshape(-1, np.shape(x)[1]), x[ii])
+    return lik
+
+
+def _first_appearance(labels):
+    # unique labels, in order of their first appearance
+    _, idx = np.unique(labels, return_index=True)
+    return labels[np.sort(idx)]
+
+
+def _mode(labels):
+    values, counts = np.unique(labels, return_counts=True)
+    return values[np.argmax(counts)]
+
+
+def _label_segments(x, labels, k):
+    # the contiguous runs of scenes of x labeled k
+    is_k = np.concatenate([[False], labels == k, [False]])
+    changes = np.nonzero(np.diff(is_k.astype(int)))[0]
+    return [x[a:b] for a, b in zip(changes[::2], changes[1::2])]
+
+
+def _segment_log_likelihood(e_model, X):
+    # log likelihood of each scene of a contiguous segment under an event model, as in run:
+    # the first scene given the initial point, the others given the preceding scenes
+    log_likelihood = [e_model.log_likelihood_f0(X[0])]
+    if not e_model.f_is_trained:
+        log_likelihood += [e_model.log_likelihood_next(X[ii - 1], X[ii]) for ii in range(1, np.shape(X)[0])]
+    elif np.shape(X)[0] > 1:
+        x_hat = np.reshape(e_model.predict_next_generative_batch(X[:-1]), np.shape(X[1:]))
+        log_likelihood += list(diagonal_mvnorm_logprob(X[1:] - x_hat, e_model.Sigma_inv, e_model.Sigma_log_det))
+    return np.array(log_likelihood)
+
+
+def segmentation_agreement(e_hat_a, e_hat_b, log_boundary_probability_a=None, log_boundary_probability_b=None):
+    """
+    Compares two segmentations of the same scenes, e.g. a sequential (run) and an approximate
+    (run_chunked) segmentation
+
+    :param e_hat_a: labels of the first segmentation (the reference)
+    :param e_hat_b: labels of the second segmentation
+    :param log_boundary_probability_a: (optional) boundary probabilities of the first segmentation
+    :param log_boundary_probability_b: (optional) boundary probabilities of the second segmentation
+    :return: dictionary with
+             label_agreement, fraction of scenes with the same label, after mapping each label of
+                 b to the label of a it co-occurs with most
+             boundary_agreement, fraction of scenes where both or neither segmentation has a
+                 boundary (a change of label)
+             n_event_types_a, n_event_types_b, number of event types of each segmentation
+             boundary_probability_difference, mean absolute difference of the boundary
+                 probabilities (if given)
+    """
+    e_hat_a, e_hat_b = np.asarray(e_hat_a), np.asarray(e_hat_b)
+    mapped = np.copy(e_hat_a)
+    for k in np.unique(e_hat_b):
+        mapped[e_hat_b == k] = _mode(e_hat_a[e_hat_b == k])
+
+    boundaries_a, boundaries_b = np.diff(e_hat_a) != 0, np.diff(e_hat_b) != 0
+
+    agreement = dict(
+        label_agreement=np.mean(mapped == e_hat_a),
+        boundary_agreement=np.mean(boundaries_a == boundaries_b) if boundaries_a.size > 0 else 1.,
+        n_event_types_a=np.unique(e_hat_a).size,
+        n_event_types_b=np.unique(e_hat_b).size,
+    )
+    if log_boundary_probability_a is not None and log_boundary_probability_b is not None:
+        agreement['boundary_probability_difference'] = np.mean(
+            np.abs(np.exp(log_boundary_probability_a) - np.exp(log_boundary_probability_b)))
+    return agreement
+
+
 @processify
 def sem_run(x, sem_init_kwargs=None, run_kwargs=None):
     """ this initailizes SEM, runs the main function 'run', and
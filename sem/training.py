@@ -0,0 +1,191 @@
+import sys
+import threading
+import traceback
+import numpy as np
+from queue import Queue
+from .event_models import set_thread_model
+
+
+class AsyncTrainer(object):
+    """
+    Trains the event models on a background thread, decoupled from inference.
+
+    The training of the event models (the training pairs, the gradient steps and the
+    variance) is queued and run, in order, by a single worker thread that owns a separate
+    copy of the network, while the inference loop keeps evaluating the likelihoods with the
+    last published weights of each event model.  The histories of scenes that the
+    predictions condition on are always up to date, only the weights can be stale.
+
+    Parameters
+    ----------
+    model: keras model
+        a compiled copy of the network shared by the event models, used only for training
+        (see event_models.set_thread_model)
+
+    max_staleness: int or None (default 1)
+        maximum number of queued updates that have not been trained on when inference
+        continues (wait blocks until there are no more).  0 is equivalent to training
+        synchronously, None does not wait (only the queue size is bounded)
+
+    max_queue_size: int (default 32)
+        maximum number of queued updates, submitting blocks while the queue is full
+
+    """
+
+    def __init__(self, model, max_staleness=1, max_queue_size=32):
+        self.model = model
+        self.max_staleness = max_staleness
+        self.queue = Queue(maxsize=max_queue_size)
+        self.n_submitted = 0
+        self.n_completed = 0
+        self.error = None
+        self._completed = threading.Condition()
+
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        set_thread_model(self.model)
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+
+            # after an error, the remaining updates are dropped and the error is raised in the
+            # inference thread
+            if self.error is None:
+                func, args = task
+                try:
+                    func(*args)
+                except Exception:
+                    ex_type, ex_value, tb = sys.exc_info()
+                    self.error = ex_type, ex_value, ''.join(traceback.format_tb(tb))
+
+            with self._completed:
+                self.n_completed += 1
+                self._completed.notify_all()
+
+    def _raise_error(self):
+        if self.error:
+            ex_type, ex_value, tb_str = self.error
+            message = '%s (in training thread)\n%s' % (str(ex_value), tb_str)
+            raise ex_type(message)
+
+    def submit(self, func, *args):
+        """ queue func(*args) to run on the training thread """
+        self._raise_error()
+        self.n_submitted += 1
+        self.queue.put((func, args))
+
+    # the histories of the event models are updated on the inference thread, when the update is
+    # submitted, as the predictions condition on them.  Only the training (storing the training
+    # pairs, the gradient steps and the variance) is queued
+
+    def update(self, e_model, X, Xp):
+        """ asynchronous version of e_model.update(X, Xp) """
+        self.submit(e_model.fit_pair, *e_model.add_to_history(X, Xp))
+
+    def new_token(self, e_model, Xp):
+        """ asynchronous version of e_model.new_token() followed by e_model.update_f0(Xp) """
+        e_model.new_token()
+        self.submit(e_model.fit_f0, *e_model.add_to_history(np.zeros(e_model.d), Xp))
+
+    def wait(self, max_staleness=None):
+        """ block until no more than max_staleness (default: self.max_staleness) updates are pending """
+        if max_staleness is None:
+            max_staleness = self.max_staleness
+        if max_staleness is not None:
+            with self._completed:
+                self._completed.wait_for(lambda: self.n_submitted - self.n_completed <= max_staleness)
+        self._raise_error()
+
+    def join(self):
+        """ barrier: block until every queued update has been trained on """
+        self.wait(0)
+
+    def close(self):
+        """ train on the remaining updates and stop the worker thread """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise_error()
+
+
+class UpdateScheduler(object):
+    """
+    Decides which updates of an event model train the network, and when to stop training.
+    The prediction error still counts towards the variance on the updates that are skipped,
+    and an untrained event model always trains.  Pass an instance as the update_scheduler of
+    the event models (it can be shared by all of them, through f_opts).
+
+    This base class trains on every update, with an optional early stopping rule: training
+    stops before n_epochs once the minibatch loss has not improved by more than min_delta for
+    patience epochs.
+
+    Parameters
+    ----------
+    patience: int or None (default None)
+        number of epochs without improvement before stopping early.  None always trains
+        for n_epochs
+
+    min_delta: float (default 0.)
+        minimum decrease of the loss counted as an improvement
+
+    """
+
+    def __init__(self, patience=None, min_delta=0.):
+        self.patience = patience
+        self.min_delta = min_delta
+
+    def should_train(self, e_model):
+        """ train the network of e_model on its most recent update? """
+        return True
+
+    def keep_training(self, losses):
+        """ continue training, given the minibatch losses of the epochs so far? """
+        if self.patience is None or len(losses) <= self.patience:
+            return True
+        best_before = np.min(losses[:-self.patience])
+        return np.min(losses[-self.patience:]) < best_before - self.min_delta
+
+
+class EveryMScheduler(UpdateScheduler):
+    """
+    Trains on every m-th update of each event model
+
+    Parameters
+    ----------
+    m: int
+        number of updates between trainings
+
+    """
+
+    def __init__(self, m, patience=None, min_delta=0.):
+        UpdateScheduler.__init__(self, patience=patience, min_delta=min_delta)
+        self.m = int(m)
+
+    def should_train(self, e_model):
+        return e_model.training_pairs.n_seen % self.m == 0
+
+
+class SurpriseScheduler(UpdateScheduler):
+    """
+    Trains only on surprising updates: when the squared prediction error of the current
+    weights on the new scene exceeds threshold times the estimated variance (Sigma),
+    averaged over the dimensions.  For a well calibrated model the ratio is ~1, so a
+    threshold of 2. skips the scenes that are already well predicted
+
+    Parameters
+    ----------
+    threshold: float (default 2.)
+        multiple of Sigma above which to train
+
+    """
+
+    def __init__(self, threshold=2., patience=None, min_delta=0.):
+        UpdateScheduler.__init__(self, patience=patience, min_delta=min_delta)
+        self.threshold = threshold
+
+    def should_train(self, e_model):
+        error = np.reshape(e_model.last_prediction_error(), -1)
+        return np.mean(error ** 2 / e_model.Sigma) > self.threshold
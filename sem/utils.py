@@ -22,7 +22,8 @@ def unroll_data(x, t=1):
     output
     ------
 
-        X_unrolled: array, shape (N-1, t, D)
+        X_unrolled: array, shape (N, t, D)
+            a read-only sliding-window view over the zero-padded data (no per-window copies)
 
     """
     if np.ndim(x) == 2:
@@ -31,15 +32,35 @@ def unroll_data(x, t=1):
         n, d = 1, np.shape(x)[0]
         x = np.reshape(x, (1, d))
 
-    x_unrolled = np.zeros((n, t, d))
-
     # append a t-1 blank (zero) input patterns to the beginning
-    data_set = np.concatenate([np.zeros((t - 1, d)), x])
+    data_set = np.ascontiguousarray(np.concatenate([np.zeros((t - 1, d)), x]))
+
+    # window ii is data_set[ii: ii + t, :]
+    s0, s1 = data_set.strides
+    return np.lib.stride_tricks.as_strided(data_set, shape=(n, t, d), strides=(s0, s0, s1), writeable=False)
+
 
-    for ii in range(n):
-        x_unrolled[ii, :, :] = data_set[ii: ii + t, :]
+def unroll_last(x, t=1):
+    """
+    Fast path of unroll_data(x, t)[-1:, :, :] that only builds the final window
 
-    return x_unrolled
+    Parameters:
+        x: array, shape (N, D) or shape (D,)
+
+        t: int
+            time-steps to truncate the unroll
+
+    output
+    ------
+
+        X_unrolled: array, shape (1, t, D)
+
+    """
+    x = np.reshape(x, (-1, np.shape(x)[-1]))
+    n, d = np.shape(x)
+    x_last = np.zeros((1, t, d))
+    x_last[0, max(t - n, 0):, :] = x[max(n - t, 0):, :]
+    return x_last
 
 # precompute for speed (doesn't really help but whatever)
 log_2pi = np.log(2.0 * np.pi)
@@ -50,19 +71,45 @@ def fast_mvnorm_diagonal_logprob(x, variances):
 
     Parameters:
 
-        x: array, shape (D,)
-            observations
+        x: array, shape (D,) or (N, D)
+            observations, one per row
 
-        variances: array, shape (D,)
-            Diagonal values of the covariance function
+        variances: array, shape (D,) or (N, D)
+            Diagonal values of the covariance function(s)
 
     output
     ------
 
-        log-probability: float
+        log-probability: float, or N-length array for 2-d x
+
+    """
+    return -0.5 * (log_2pi * np.shape(x)[-1] + np.sum(np.log(variances) + (x**2) / variances, axis=-1))
+
 
+def diagonal_mvnorm_logprob(x, inv_variances, log_det):
     """
-    return -0.5 * (log_2pi * np.shape(x)[0] + np.sum(np.log(variances) + (x**2) / variances ))
+    Batched version of fast_mvnorm_diagonal_logprob, for many residuals against many
+    diagonal covariance functions at once, with the inverse variances and the
+    log-determinants precomputed
+
+    Parameters:
+
+        x: array, shape (..., D)
+            observations (residuals)
+
+        inv_variances: array, shape (..., D), broadcastable against x
+            inverse of the diagonal values of the covariance function(s)
+
+        log_det: float or array, broadcastable against x[..., 0]
+            log-determinant of the covariance function(s), i.e. sum(log(variances))
+
+    output
+    ------
+
+        log-probability: array, shape (...)
+
+    """
+    return -0.5 * (log_2pi * np.shape(x)[-1] + log_det + np.sum(x ** 2 * inv_variances, axis=-1))
 
 
 def get_prior_scale(df, target_variance):
@@ -84,6 +131,110 @@ def get_prior_scale(df, target_variance):
     """
     return target_variance * (df + 2) / df
 
+class ReplayBuffer(object):
+    """
+    Capacity-bounded store of (x, xp) training pairs for an event model.
+
+    The pairs are kept in preallocated arrays, so the memory footprint is fixed by the
+    capacity and drawing a minibatch is O(batch_size) regardless of the length of the run.
+
+    Parameters:
+
+        capacity: int or None (default None)
+            maximum number of stored pairs. None stores every pair (the arrays grow
+            geometrically)
+
+        mode: str, 'reservoir' (default) or 'recency'
+            'reservoir': reservoir sampling (Algorithm R), the stored pairs are a uniform
+                sample of every pair seen
+            'recency': once the buffer is full, every new pair replaces a random stored
+                pair, so the probability that a pair is kept decays exponentially with its
+                age (with a time-constant of ~capacity pairs)
+
+    """
+
+    def __init__(self, capacity=None, mode='reservoir'):
+        if mode not in ('reservoir', 'recency'):
+            raise ValueError("mode must be 'reservoir' or 'recency'")
+        if capacity is not None and capacity < 1:
+            raise ValueError("capacity must be a positive integer or None")
+        self.capacity = capacity
+        self.mode = mode
+        self.x = None
+        self.xp = None
+        self.size = 0  # number of stored pairs
+        self.n_seen = 0  # number of pairs added
+        self.x_last = None  # the most recent pair is always kept, to update the variance estimate
+        self.xp_last = None
+
+    def __len__(self):
+        return self.size
+
+    def _allocate(self, x, xp, n):
+        x_new = np.zeros((n,) + np.shape(x))
+        xp_new = np.zeros((n,) + np.shape(xp))
+        if self.size > 0:
+            x_new[:self.size] = self.x[:self.size]
+            xp_new[:self.size] = self.xp[:self.size]
+        self.x, self.xp = x_new, xp_new
+
+    def append(self, x, xp):
+        """ add a single training pair, x and xp are a single input and output (no batch axis) """
+        if self.x is None:
+            self._allocate(x, xp, self.capacity if self.capacity is not None else 16)
+
+        if self.capacity is None or self.size < self.capacity:
+            if self.size == np.shape(self.x)[0]:
+                self._allocate(x, xp, 2 * self.size)
+            idx = self.size
+            self.size += 1
+        elif self.mode == 'reservoir':
+            idx = np.random.randint(self.n_seen + 1)
+        else:
+            idx = np.random.randint(self.capacity)
+        self.n_seen += 1
+
+        if idx < self.size:
+            self.x[idx] = x
+            self.xp[idx] = xp
+        self.x_last = np.array(x, dtype=float)
+        self.xp_last = np.array(xp, dtype=float)
+
+    def sample(self, n):
+        """ draw n pairs uniformly (with replacement), returns arrays x, xp with a leading batch axis """
+        idx = np.random.randint(self.size, size=n)
+        return self.x[idx], self.xp[idx]
+
+    def all(self):
+        """ every stored pair, returns arrays x, xp with a leading batch axis """
+        return self.x[:self.size], self.xp[:self.size]
+
+    def last(self):
+        """ the most recent pair, returns arrays x, xp with a leading batch axis of 1 """
+        return self.x_last[np.newaxis], self.xp_last[np.newaxis]
+
+    def get_state(self):
+        """ the stored pairs and counters, as a flat dictionary of arrays (empty if no pairs were added) """
+        if self.n_seen == 0:
+            return dict()
+        return dict(x=self.x[:self.size], xp=self.xp[:self.size], x_last=self.x_last, xp_last=self.xp_last,
+                    n_seen=np.array(self.n_seen))
+
+    def set_state(self, state):
+        self.x, self.xp, self.size, self.n_seen = None, None, 0, 0
+        self.x_last, self.xp_last = None, None
+        if len(state) == 0:
+            return
+        size = np.shape(state['x'])[0]
+        self._allocate(state['x_last'], state['xp_last'], max(size, self.capacity or 16))
+        self.x[:size] = state['x']
+        self.xp[:size] = state['xp']
+        self.size = size
+        self.n_seen = int(state['n_seen'])
+        self.x_last = np.array(state['x_last'])
+        self.xp_last = np.array(state['xp_last'])
+
+
 def delete_object_attributes(myobj):
     # take advantage of mutability here
     while myobj.__dict__.items():
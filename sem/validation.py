@@ -0,0 +1,293 @@
+"""
+Golden-output equivalence checks for the optimized code paths of SEM.
+
+A set of seeded reference cases (SEM.run, SEM.run_w_boundaries and the gibbs memory sampler,
+on the bundled motion data, on synthetic sequences and on a stand-in for a movie of Zacks et
+al. (2006)) is run once to store the golden outputs.  The same cases are then re-run under an
+optimized mode (see MODES), and their outputs are compared to the golden outputs within the
+tolerances in TOLERANCES.  The run times are recorded alongside, e.g.
+
+    from sem.validation import save_golden, compare_to_golden, print_report
+    print_report(compare_to_golden('golden/', mode='async'))
+
+or from the command line:
+
+    python -m sem.validation golden/ --mode async
+
+The golden outputs have to come from the reference tree, the baseline commit (f04020b) from
+before the optimized modes, so that the changes to the reference code path are checked as
+well.  They depend on the tensorflow version, so they are not part of the repository: generate
+them once per environment.  This module and datasets.py only use the API of the baseline, so
+they can be copied into a checkout of it:
+
+    git worktree add ../sem-baseline f04020b
+    cp sem/validation.py sem/datasets.py ../sem-baseline/sem/
+    (cd ../sem-baseline && python -m sem.validation /path/to/golden/ --save)
+
+"""
+import os
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from .sem import SEM
+from .event_models import LinearEvent, GRUEvent
+from .memory import create_corrupted_trace, gibbs_memory_sampler, reconstruction_accuracy
+from .datasets import load_motion_events, zacks2006_boundary_frequency
+
+try:
+    from .training import SurpriseScheduler
+except ImportError:
+    # the baseline tree, which only runs the reference mode (see above)
+    SurpriseScheduler = None
+
+# SEM and memory parameters shared by all of the cases
+SEM_KWARGS = dict(lmda=1.0, alfa=10.0)
+MEMORY_KWARGS = dict(tau=0.1, epsilon_e=0.25, b=2)
+GIBBS_KWARGS = dict(memory_epsilon=np.exp(-10), n_samples=50, n_burnin=10)
+
+# the optimized modes, as overrides of the keyword arguments of the cases:
+#   sem_kwargs -> SEM(), f_opts -> the event models, run_kwargs -> SEM.run,
+#   run_w_boundaries_kwargs -> SEM.run_w_boundaries, gibbs_kwargs -> gibbs_memory_sampler
+MODES = {
+    'reference': dict(),
+    'async': dict(run_kwargs=dict(async_training=True, max_staleness=1)),
+    'replay_buffer': dict(f_opts=dict(replay_capacity=256)),
+    'blocked_gibbs': dict(gibbs_kwargs=dict(e_sampler='blocked')),
+    'no_diagnostics': dict(run_kwargs=dict(store_diagnostics=False)),
+    'threads': dict(run_w_boundaries_kwargs=dict(n_threads=4)),
+}
+if SurpriseScheduler is not None:
+    MODES['surprise_schedule'] = dict(f_opts=dict(update_scheduler=SurpriseScheduler(threshold=2.)))
+
+# maximum allowed difference of each output from the golden output:
+#   e_hat: fraction of scenes (or events) with a different MAP label
+#   post: maximum absolute difference of the posterior probabilities
+#   log_boundary_probability: maximum absolute difference of the boundary probabilities
+#   reconstruction_accuracy: absolute difference of the mean reconstruction accuracy
+#   boundary_correlation: absolute difference of the correlation with the human boundaries
+TOLERANCES = dict(e_hat=0.05, post=0.05, log_boundary_probability=0.05, reconstruction_accuracy=0.05,
+                  boundary_correlation=0.05)
+
+
+def make_synthetic_events(n_types=3, n_events=12, event_length=8, d=8, noise=0.05, seed=0):
+    """
+    Synthetic sequence of events: each event type drifts in its own direction from its own
+    starting point, with Gaussian noise
+
+    :return: list_events, list of event_length x d arrays
+             event_types, n_events array of the event type of each event
+    """
+    rng = np.random.RandomState(seed)
+    starts = rng.randn(n_types, d) / np.sqrt(d)
+    drifts = rng.randn(n_types, d) / np.sqrt(d) * 0.25
+    event_types = rng.randint(n_types, size=n_events)
+    return _drifting_events(starts, drifts, event_types, [event_length] * n_events, noise, rng), event_types
+
+
+def make_zacks_events(movie='C', frequency=3, n_types=4, event_interval=10, d=8, noise=0.05, seed=0):
+    """
+    Synthetic stand-in for the scene embeddings of a movie of Zacks et al. (2006), as in the
+    video segmentation demo: drifting events (see make_synthetic_events) at frequency scenes
+    per second, with an event boundary at each of the seconds the subjects mark as a boundary
+    most often (one per event_interval seconds on average)
+
+    :param movie: 'A', 'B' or 'C' (see datasets.ZACKS2006_MOVIES)
+    :return: list_events, list of n_scenes x d arrays
+             boundary_frequency, the subjects' boundary frequency in each second of the movie
+    """
+    boundary_frequency = zacks2006_boundary_frequency(movie)
+    n_seconds = len(boundary_frequency)
+    boundaries = np.sort(np.argsort(boundary_frequency, kind='stable')[-(n_seconds // event_interval):])
+    seconds = np.diff(np.unique(np.concatenate([[0], boundaries, [n_seconds]])))
+
+    rng = np.random.RandomState(seed)
+    starts = rng.randn(n_types, d) / np.sqrt(d)
+    drifts = rng.randn(n_types, d) / np.sqrt(d) * 0.25
+    event_types = rng.randint(n_types, size=len(seconds))
+    return _drifting_events(starts, drifts, event_types, seconds * frequency, noise, rng), boundary_frequency
+
+
+def _drifting_events(starts, drifts, event_types, event_lengths, noise, rng):
+    d = np.shape(starts)[1]
+    return [
+        starts[e] + np.arange(n).reshape(-1, 1) * drifts[e] + rng.randn(n, d) * noise
+        for e, n in zip(event_types, event_lengths)
+    ]
+
+
+def _seed(seed):
+    np.random.seed(seed)
+    tf.random.set_seed(seed)
+
+
+def _make_sem(f_class, f_opts, mode):
+    sem_kwargs = dict(SEM_KWARGS, **mode.get('sem_kwargs', dict()))
+    return SEM(f_class=f_class, f_opts=dict(f_opts, **mode.get('f_opts', dict())), **sem_kwargs)
+
+
+def _case_run(list_events, f_class, f_opts, seed, mode):
+    _seed(seed)
+    sem_model = _make_sem(f_class, f_opts, mode)
+    t0 = time.time()
+    sem_model.run(np.concatenate(list_events, axis=0), progress_bar=False, **mode.get('run_kwargs', dict()))
+    elapsed = time.time() - t0
+    outputs = dict(e_hat=sem_model.results.e_hat, post=sem_model.results.post,
+                   log_boundary_probability=sem_model.results.log_boundary_probability)
+    sem_model.clear()
+    return outputs, elapsed
+
+
+def _case_zacks(movie, f_class, f_opts, seed, mode, frequency=3):
+    # SEM.run on the stand-in for the movie, and the correlation of the boundary probability of
+    # SEM (averaged over each second) with the boundary frequency of the subjects
+    list_events, boundary_frequency = make_zacks_events(movie, frequency=frequency)
+    outputs, elapsed = _case_run(list_events, f_class, f_opts, seed, mode)
+    boundary_probability = np.exp(outputs['log_boundary_probability']).reshape(-1, frequency).mean(axis=1)
+    outputs['boundary_correlation'] = np.corrcoef(boundary_probability, boundary_frequency)[0, 1]
+    return outputs, elapsed
+
+
+def _case_run_w_boundaries(list_events, f_class, f_opts, seed, mode):
+    _seed(seed)
+    sem_model = _make_sem(f_class, f_opts, mode)
+    t0 = time.time()
+    sem_model.run_w_boundaries(list_events, progress_bar=False, **mode.get('run_w_boundaries_kwargs', dict()))
+    elapsed = time.time() - t0
+    outputs = dict(e_hat=sem_model.results.e_hat, post=sem_model.results.post)
+    sem_model.clear()
+    return outputs, elapsed
+
+
+def _case_gibbs(list_events, f_class, f_opts, seed, mode):
+    _seed(seed)
+    sem_model = _make_sem(f_class, f_opts, mode)
+    x = np.concatenate(list_events, axis=0)
+    sem_model.run(x, progress_bar=False, **mode.get('run_kwargs', dict()))
+    y_mem = create_corrupted_trace(x, sem_model.results.e_hat, **MEMORY_KWARGS)
+
+    # only the sampler is timed
+    _seed(seed)
+    gibbs_kwargs = dict(GIBBS_KWARGS, **mode.get('gibbs_kwargs', dict()))
+    t0 = time.time()
+    y_samples, _, _ = gibbs_memory_sampler(
+        y_mem, sem_model, memory_alpha=sem_model.alfa, memory_lambda=sem_model.lmda, b=MEMORY_KWARGS['b'],
+        tau=MEMORY_KWARGS['tau'], progress_bar=False, **gibbs_kwargs
+    )
+    elapsed = time.time() - t0
+    outputs = dict(reconstruction_accuracy=np.mean(reconstruction_accuracy(y_samples, y_mem)))
+    sem_model.clear()
+    return outputs, elapsed
+
+
+_synthetic_opts = (LinearEvent, dict(n_epochs=10))
+_motion_opts = (GRUEvent, dict(t=3, n_epochs=5))
+
+# name -> function(seed, mode) returning (outputs, elapsed time)
+CASES = {
+    'run_synthetic': lambda seed, mode: _case_run(make_synthetic_events()[0], *_synthetic_opts, seed, mode),
+    'run_motion': lambda seed, mode: _case_run(load_motion_events(), *_motion_opts, seed, mode),
+    'run_w_boundaries_synthetic': lambda seed, mode: _case_run_w_boundaries(
+        make_synthetic_events()[0], *_synthetic_opts, seed, mode),
+    'run_w_boundaries_motion': lambda seed, mode: _case_run_w_boundaries(
+        load_motion_events(), *_motion_opts, seed, mode),
+    'gibbs_synthetic': lambda seed, mode: _case_gibbs(make_synthetic_events()[0], *_synthetic_opts, seed, mode),
+    'run_zacks_dishes': lambda seed, mode: _case_zacks('C', *_synthetic_opts, seed, mode),
+}
+
+
+def _get_mode(mode):
+    if isinstance(mode, dict):
+        return mode
+    return MODES[mode]
+
+
+def save_golden(path, cases=None, seed=0, mode='reference'):
+    """
+    Runs the cases and stores their outputs (and run times) as the golden outputs, one
+    .npz file per case in path
+
+    :param path: directory of the golden outputs
+    :param cases: list of the names of the cases to run (default: all of CASES)
+    :param seed: random seed of numpy and tensorflow
+    :param mode: name of a mode in MODES, or a dictionary of overrides.  Normally the reference
+    """
+    os.makedirs(path, exist_ok=True)
+    if cases is None:
+        cases = list(CASES.keys())
+    for case in cases:
+        outputs, elapsed = CASES[case](seed, _get_mode(mode))
+        np.savez(os.path.join(path, case + '.npz'), elapsed=elapsed, **outputs)
+
+
+def _difference(name, golden, output):
+    golden, output = np.asarray(golden), np.asarray(output)
+    if name == 'e_hat':
+        return np.mean(golden != output)
+    if name == 'post':
+        # the number of event types can differ, compare over the union
+        k = max(np.shape(golden)[1], np.shape(output)[1])
+        golden = np.pad(golden, ((0, 0), (0, k - np.shape(golden)[1])))
+        output = np.pad(output, ((0, 0), (0, k - np.shape(output)[1])))
+        return np.max(np.abs(golden - output))
+    if name == 'log_boundary_probability':
+        return np.max(np.abs(np.exp(golden) - np.exp(output)))
+    return np.max(np.abs(golden - output))
+
+
+def compare_to_golden(path, mode='reference', cases=None, seed=0, tolerances=None):
+    """
+    Re-runs the cases under mode and compares their outputs to the golden outputs in path
+
+    :param path: directory of the golden outputs (see save_golden)
+    :param mode: name of a mode in MODES, or a dictionary of overrides
+    :param cases: list of the names of the cases to run (default: every case with golden outputs)
+    :param seed: random seed of numpy and tensorflow, should match the golden outputs
+    :param tolerances: dictionary of tolerances, overriding TOLERANCES
+
+    :return: report, a list with a dictionary per case and output (case, output, difference,
+             tolerance, passed, golden_time, time, speedup)
+    """
+    tolerances = dict(TOLERANCES, **(tolerances or dict()))
+    if cases is None:
+        cases = [case for case in CASES.keys() if os.path.exists(os.path.join(path, case + '.npz'))]
+
+    report = []
+    for case in cases:
+        with np.load(os.path.join(path, case + '.npz')) as golden:
+            golden = dict(golden)
+        outputs, elapsed = CASES[case](seed, _get_mode(mode))
+        golden_time = float(golden.pop('elapsed'))
+        for name, value in golden.items():
+            difference = _difference(name, value, outputs[name])
+            report.append(dict(
+                case=case, output=name, difference=difference, tolerance=tolerances[name],
+                passed=bool(difference <= tolerances[name]), golden_time=golden_time, time=elapsed,
+                speedup=golden_time / elapsed,
+            ))
+    return report
+
+
+def print_report(report):
+    for row in report:
+        print('{case:<28s} {output:<26s} diff={difference:8.4f} (tol {tolerance:.3f}) {status:4s}  '
+              'time={time:7.2f}s golden={golden_time:7.2f}s speedup={speedup:5.2f}x'.format(
+                  status='ok' if row['passed'] else 'FAIL', **row))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Golden-output equivalence checks for SEM')
+    parser.add_argument('path', help='directory of the golden outputs')
+    parser.add_argument('--save', action='store_true', help='store the golden outputs (reference mode)')
+    parser.add_argument('--mode', default='reference', choices=sorted(MODES.keys()))
+    parser.add_argument('--cases', nargs='*', default=None, choices=sorted(CASES.keys()))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.save:
+        save_golden(args.path, cases=args.cases, seed=args.seed)
+    else:
+        report = compare_to_golden(args.path, mode=args.mode, cases=args.cases, seed=args.seed)
+        print_report(report)
+        if not all(row['passed'] for row in report):
+            raise SystemExit(1)